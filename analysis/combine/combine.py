@@ -0,0 +1,268 @@
+import glob
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '../county'))
+from countyindex import CountyIndex, fips
+import store
+
+RAW = os.path.join(HERE, '../../data/ACI_output/raw')
+OUTPUT = os.path.join(HERE, 'output')
+
+# Ag variables of the raw ACI outputs, in the AgVar order of combine_all.ipynb
+AGVARS = ['gdd', 'egdd', 'prcp']
+
+# Per-model AgVar files and GMFD of each combined table of combine_all.ipynb
+GMFD = os.path.join(RAW, 'GMFD/agvar_historical_gmfd.csv')
+SOURCES = {'nex_agvar_hist': os.path.join(RAW, 'NEX/agvar_historical_r1i1p1_*.csv'),
+           'nex_agvar_proj': os.path.join(RAW, 'NEX/agvar_rcp85_r1i1p1_*.csv'),
+           'cmip_agvar_all': os.path.join(RAW, 'CMIP/agvar_*historical+rcp85.csv')}
+
+# Non-member columns of a combined table
+MEAN = 'ensemble_mean'
+TRUTH = 'GMFD'
+
+
+def model_name(path):
+    """
+    Model name of a raw AgVar file, e.g. 'CCSM4' for agvar_CCSM4_historical+rcp85.csv
+    """
+    name = os.path.basename(path)
+    for part in ['agvar_', 'historical_r1i1p1_', 'rcp85_r1i1p1_', '.historical+rcp85', '_historical+rcp85', '.csv']:
+        name = name.replace(part, '')
+    return name
+
+
+def model_files(pattern):
+    """
+    Dict of model name to path of the raw AgVar files matching a glob pattern, sorted by name
+    """
+    return {model_name(path): path for path in sorted(glob.glob(pattern), key=model_name)}
+
+
+def read_agvar(path, agvars=AGVARS):
+    """
+    Read a raw AgVar CSV (GEOID, Year and one column per AgVar) with declared dtypes
+    """
+    dtype = dict({'GEOID': str, 'Year': np.int32}, **{agvar: np.float64 for agvar in agvars})
+    data = pd.read_csv(path, usecols=list(dtype), dtype=dtype)
+    data['GEOID'] = fips(data['GEOID'])
+    return data
+
+
+def read_all(paths, agvars=AGVARS, max_workers=8):
+    """
+    Read many raw AgVar CSVs concurrently, returning a list of DataFrames in the order of 'paths'
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda path: read_agvar(path, agvars), paths))
+
+
+class Ensemble:
+    """
+    Ensemble of AgVars as a dense (AgVar, GEOID, Year, model) cube, the layout of the
+    combined tables of combine_all.ipynb
+
+    The running sum and count of the members over each (AgVar, GEOID, Year) are kept, so
+    adding or replacing a model updates 'ensemble_mean' without going over the other members.
+
+    Attributes:
+        - agvars : Index of the AgVars
+        - counties : CountyIndex of the counties
+        - years : Index of the years
+        - models : List of the member models
+        - values : Array (agvars, counties, years, models), NaN where a model has no value
+        - truth : Array (agvars, counties, years) of GMFD, None without it
+    """
+
+    def __init__(self, agvars, counties, years, models=(), values=None, truth=None):
+        self.agvars = pd.Index(agvars, name='AgVar')
+        self.counties = counties
+        self.years = pd.Index(years, name='Year')
+        self.models = list(models)
+        shape = (len(self.agvars), len(counties), len(self.years))
+        self.values = values if values is not None else np.full(shape + (0,), np.nan)
+        self.truth = truth
+        self._sum = np.nansum(self.values, axis=-1)
+        self._count = (~np.isnan(self.values)).sum(axis=-1, dtype=np.int32)
+
+    @classmethod
+    def from_files(cls, paths, gmfd=GMFD, agvars=AGVARS, max_workers=8):
+        """
+        Build the ensemble of raw AgVar files, read concurrently and scattered into a
+        cube allocated once for the union of their counties and years
+
+        Inputs:
+            - paths : Dict of model name to raw AgVar CSV (see model_files)
+            - gmfd : GMFD AgVar CSV, none if None
+            - agvars : AgVar columns of the files
+            - max_workers : Number of files read at once
+        """
+        models = list(paths)
+        files = [paths[model] for model in models] + ([gmfd] if gmfd is not None else [])
+        frames = read_all(files, agvars, max_workers)
+        counties = CountyIndex(np.unique(np.concatenate([frame['GEOID'].unique() for frame in frames])))
+        years = np.unique(np.concatenate([frame['Year'].unique() for frame in frames]))
+        ensemble = cls(agvars, counties, years, models,
+                       np.full((len(agvars), len(counties), len(years), len(models)), np.nan))
+        for m, frame in enumerate(frames[:len(models)]):
+            ensemble._scatter(frame, ensemble.values[..., m])
+        if gmfd is not None:
+            ensemble.truth = np.full(ensemble.values.shape[:-1], np.nan)
+            ensemble._scatter(frames[-1], ensemble.truth)
+        ensemble._sum = np.nansum(ensemble.values, axis=-1)
+        ensemble._count = (~np.isnan(ensemble.values)).sum(axis=-1, dtype=np.int32)
+        return ensemble
+
+    @classmethod
+    def from_store(cls, path):
+        """
+        Load an ensemble written by save
+        """
+        cube = store.Store(path)
+        models = cube.coords['model']
+        members = [m for m, model in enumerate(models) if model not in [MEAN, TRUTH]]
+        values = np.array(cube.values[..., members])
+        truth = np.array(cube.values[..., models.index(TRUTH)]) if TRUTH in models else None
+        return cls(cube.coords['AgVar'], CountyIndex(cube.coords['GEOID']), cube.coords['Year'],
+                   [models[m] for m in members], values, truth)
+
+    def _scatter(self, frame, out):
+        # Write the AgVar columns of a raw frame into an (agvars, counties, years) array
+        county = self.counties.positions(frame['GEOID'])
+        year = self.years.get_indexer(frame['Year'])
+        if (county < 0).any() or (year < 0).any():
+            raise KeyError('Counties or years outside the ensemble, grow it first')
+        out[:, county, year] = frame[list(self.agvars)].to_numpy(dtype=float).T
+
+    def _grow(self, frame):
+        # Extend the counties and years to those of 'frame', keeping the current values
+        geoids = self.counties.geoids.union(fips(frame['GEOID'].unique()))
+        years = self.years.union(pd.Index(frame['Year'].unique()))
+        if len(geoids) == len(self.counties) and len(years) == len(self.years):
+            return
+        counties = CountyIndex(geoids)
+        county = counties.positions(self.counties.geoids)
+        year = years.get_indexer(self.years)
+        grid = np.ix_(np.arange(len(self.agvars)), county, year)
+
+        def regrid(array, fill):
+            out = np.full((len(self.agvars), len(counties), len(years)) + array.shape[3:], fill, dtype=array.dtype)
+            out[grid] = array
+            return out
+
+        self.values = regrid(self.values, np.nan)
+        self._sum = regrid(self._sum, 0.)
+        self._count = regrid(self._count, 0)
+        if self.truth is not None:
+            self.truth = regrid(self.truth, np.nan)
+        self.counties, self.years = counties, pd.Index(years, name='Year')
+
+    def set_model(self, model, data):
+        """
+        Add a model to the ensemble, or replace it if already a member
+
+        Inputs:
+            - model : Model name, or 'GMFD' to set the observations
+            - data : Raw AgVar CSV path or DataFrame (GEOID, Year and AgVar columns)
+        """
+        frame = read_agvar(data, list(self.agvars)) if isinstance(data, str) else data
+        self._grow(frame)
+        column = np.full(self.values.shape[:-1], np.nan)
+        self._scatter(frame, column)
+        if model == TRUTH:
+            self.truth = column
+            return
+        if model in self.models:
+            m = self.models.index(model)
+            old = self.values[..., m]
+            self._sum -= np.where(np.isnan(old), 0., old)
+            self._count -= ~np.isnan(old)
+            self.values[..., m] = column
+        else:
+            self.models.append(model)
+            self.values = np.concatenate([self.values, column[..., None]], axis=-1)
+        self._sum += np.where(np.isnan(column), 0., column)
+        self._count += ~np.isnan(column)
+
+    def drop_model(self, model):
+        """
+        Remove a member model from the ensemble
+        """
+        m = self.models.index(model)
+        old = self.values[..., m]
+        self._sum -= np.where(np.isnan(old), 0., old)
+        self._count -= ~np.isnan(old)
+        self.values = np.delete(self.values, m, axis=-1)
+        self.models.pop(m)
+
+    @property
+    def ensemble_mean(self):
+        """
+        Mean over the members with a value, NaN where none has one
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(self._count > 0, self._sum / self._count, np.nan)
+
+    def columns(self):
+        """
+        Column names of the combined table: the members, 'ensemble_mean' and 'GMFD' if present
+        """
+        return self.models + [MEAN] + ([TRUTH] if self.truth is not None else [])
+
+    def cube(self):
+        """
+        Array (agvars, counties, years, columns) of the members, ensemble mean and GMFD
+        """
+        out = np.empty(self.values.shape[:-1] + (len(self.columns()),))
+        out[..., :len(self.models)] = self.values
+        out[..., len(self.models)] = self.ensemble_mean
+        if self.truth is not None:
+            out[..., -1] = self.truth
+        return out
+
+    def frame(self):
+        """
+        The combined table as a long Pandas DataFrame with AgVar, GEOID, Year and one column
+        per model, ensemble_mean and GMFD, as written by combine_all.ipynb
+
+        Rows without any value are dropped.
+        """
+        values = self.cube().reshape(-1, len(self.columns()))
+        present = ~np.isnan(values).all(axis=1)
+        index = pd.MultiIndex.from_product([self.agvars, self.counties.geoids.rename('GEOID'), self.years])
+        data = pd.DataFrame(values[present], columns=self.columns(), index=index[present])
+        return data.reset_index()
+
+    def save(self, path, dtype=np.float64):
+        """
+        Write the combined table as an on-disk cube store (see store.Store)
+        """
+        coords = {'AgVar': self.agvars.tolist(), 'GEOID': self.counties.geoids.tolist(),
+                  'Year': self.years.tolist(), 'model': self.columns()}
+        values = store.write_cube(path, coords, dtype)
+        values[...] = self.cube()
+        values.flush()
+
+
+def Combine(name, path=None, store_path=None, gmfd=GMFD, max_workers=8):
+    """
+    Build one of the combined AgVar tables of combine_all.ipynb
+
+    Inputs:
+        - name : Table in SOURCES ('nex_agvar_hist', 'nex_agvar_proj' or 'cmip_agvar_all')
+        - path : CSV to write, output/<name>.csv if None
+        - store_path : Directory of a cube store to write too, none if None
+        - gmfd : GMFD AgVar CSV merged as the 'GMFD' column, none if None
+        - max_workers : Number of files read at once
+    Returns the Ensemble
+    """
+    ensemble = Ensemble.from_files(model_files(SOURCES[name]), gmfd, max_workers=max_workers)
+    ensemble.frame().to_csv(path or os.path.join(OUTPUT, name + '.csv'), index=False)
+    if store_path is not None:
+        ensemble.save(store_path)
+    return ensemble
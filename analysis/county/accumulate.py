@@ -0,0 +1,153 @@
+import numpy as np
+import pandas as pd
+import engine
+
+
+class Accumulator:
+    """
+    Mergeable moment accumulator for the moment-based verification metrics
+
+    Holds the engine.Moments of every group (GEOID or AgVar, GEOID) and model, so
+    new years can be added, or a single model replaced, without going back over the
+    whole sample. Supports r2, mse, rmse, pearson, sdratio, var and the SPR.
+
+    Attributes:
+        - index : Index/MultiIndex of the groups
+        - models : Index of the model columns
+        - truth : Name of the column verified against
+        - moments : engine.Moments of shape (groups, models)
+    """
+
+    def __init__(self, index, models, truth, moments):
+        self.index = index
+        self.models = pd.Index(models)
+        self.truth = truth
+        self.moments = moments
+
+    @classmethod
+    def from_data(cls, data, models, truth):
+        """
+        Build an Accumulator from prepared data (see analyse.prep_yield / prep_agvar)
+
+        Inputs:
+            - data : Pandas DataFrame indexed by the grouping keys
+            - models : Model columns to accumulate
+            - truth : Column to verify against ('GMFD' or 'USDA')
+        """
+        cube = engine.make_cube(data, list(models) + [truth])
+        moments = engine.make_moments(cube.column(truth), cube.columns_of(models), cube.mask)
+        return cls(cube.index, models, truth, moments)
+
+    def add(self, data):
+        """
+        Add new rows (e.g. a new year) of prepared data, costing O(groups x models)
+        """
+        return self.merge(Accumulator.from_data(data, self.models, self.truth))
+
+    def merge(self, other):
+        """
+        Merge another Accumulator over the same models into this one, in place
+        """
+        if not self.models.equals(other.models) or self.truth != other.truth:
+            raise ValueError('Accumulators must share models and truth to be merged')
+        # Append groups that are new
+        new = other.index[self.index.get_indexer(other.index) < 0]
+        if len(new) > 0:
+            self._append_groups(new, other)
+        # Add other's sums, re-expressed about our shift
+        pos = self.index.get_indexer(other.index)
+        mom = _reshift(other.moments, self.moments.shift[pos])
+        for name in ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']:
+            getattr(self.moments, name)[pos] += getattr(mom, name)
+        return self
+
+    def replace_model(self, model, data):
+        """
+        Replace the sums of one model column from prepared data covering the full sample
+
+        Only that model's sums are rebuilt, so the cost is O(groups x years) rather than
+        O(groups x years x models). The rows of 'data' must match those already accumulated.
+
+        Inputs:
+            - model : Name of the model column to replace
+            - data : Pandas DataFrame indexed by the grouping keys with 'model' and truth columns
+        """
+        cube = engine.make_cube(data, [model, self.truth])
+        pos = self.index.get_indexer(cube.index)
+        if (pos < 0).any() or not np.array_equal(engine._count(cube.mask), self.moments.n[pos]):
+            raise ValueError('Replacement data does not cover the accumulated sample')
+        mom = engine.make_moments(cube.column(self.truth), cube.columns_of([model]), cube.mask,
+                                  shift=self.moments.shift[pos])
+        col = self.models.get_loc(model)
+        for name in ['sy', 'syy', 'sxy']:
+            getattr(self.moments, name)[pos, col] = getattr(mom, name)[:, 0]
+        return self
+
+    def metric(self, metric):
+        """
+        Return a moment-based metric (r2, mse, rmse, pearson, sdratio, var) for every group and model
+        """
+        values = getattr(engine, 'mom_' + metric)(self.moments)
+        return pd.DataFrame(values, index=self.index, columns=self.models)
+
+    def spr(self):
+        """
+        Return the spread-skill ratio, as in YieldSPR / AgVarSPR over the same columns
+        """
+        var = self.metric('var').drop(columns=['ensemble_mean']).mean(axis=1)
+        rmse = self.metric('rmse')['ensemble_mean']
+        return pd.DataFrame({'SPR': np.sqrt(var) / rmse}, index=self.index)
+
+    def save(self, path):
+        """
+        Save to a compressed .npz file
+        """
+        levels = {'level_' + str(i): np.asarray(self.index.get_level_values(i), dtype=str)
+                  for i in range(self.index.nlevels)}
+        np.savez_compressed(path, names=np.array(self.index.names, dtype=str),
+                            models=np.asarray(self.models, dtype=str), truth=self.truth,
+                            **levels, **_as_dict(self.moments))
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an Accumulator saved with save
+        """
+        with np.load(path) as f:
+            names = list(f['names'])
+            levels = [f['level_' + str(i)] for i in range(len(names))]
+            if len(names) == 1:
+                index = pd.Index(levels[0], name=names[0])
+            else:
+                index = pd.MultiIndex.from_arrays(levels, names=names)
+            moments = engine.Moments(*[f[name] for name in _FIELDS])
+            return cls(index, f['models'], str(f['truth']), moments)
+
+    def _append_groups(self, new, other):
+        # Extend all arrays with zero sums, shifted like 'other'
+        shift = other.moments.shift[other.index.get_indexer(new)]
+        fields = _as_dict(self.moments)
+        for name in _FIELDS[:-1]:
+            zeros = np.zeros((len(new), fields[name].shape[1]), dtype=fields[name].dtype)
+            fields[name] = np.concatenate([fields[name], zeros])
+        fields['shift'] = np.concatenate([fields['shift'], shift])
+        self.moments = engine.Moments(**fields)
+        self.index = self.index.append(new)
+
+
+_FIELDS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy', 'shift']
+
+
+def _as_dict(moments):
+    return {name: getattr(moments, name) for name in _FIELDS}
+
+
+def _reshift(m, shift):
+    """
+    Re-express Moments about a new per-group shift
+    """
+    d = m.shift - shift
+    return engine.Moments(m.n, m.sx + m.n * d, m.sy + m.n * d,
+                          m.sxx + 2. * d * m.sx + m.n * d ** 2,
+                          m.syy + 2. * d * m.sy + m.n * d ** 2,
+                          m.sxy + d * (m.sx + m.sy) + m.n * d ** 2, shift)
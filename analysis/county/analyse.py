@@ -3,6 +3,13 @@ import pandas as pd
 import sklearn.metrics as sklm
 import scipy.stats as ss
 from math import sqrt
+import engine
+import parallel
+import store
+import countyindex
+
+# Metrics computed as array reductions in 'engine'
+VEC_METRICS = ['r2', 'mse', 'rmse', 'mae', 'mdae', 'pearson', 'spearman', 'sdratio', 'madratio']
 
 
 def new_r2(x, model, gmfd, usda):
@@ -42,23 +49,27 @@ def spr_var(x, model):
 
 
 def new_madratio(x, model, gmfd, usda):
-    return ss.median_absolute_deviation(x[model]) / ss.median_absolute_deviation(x[gmfd * 'GMFD' + usda * 'USDA'])
+    return ss.median_abs_deviation(x[model]) / ss.median_abs_deviation(x[gmfd * 'GMFD' + usda * 'USDA'])
 
 
 def make_sa(data):
     return (data - data.mean())/np.std(data)
 
 
-def AgVarVerify(data, metric, yearMin=1956, yearMax=2005):
+def as_frame(data, yearMin, yearMax):
     """
-    Calculate verification metrics of each ensemble member against GMFD truth
+    Read the years needed from a store.Store, DataFrames are passed through
+    """
+    if isinstance(data, store.Store):
+        return data.frame(years=(yearMin, yearMax))
+    return data
 
-    Inputs:
-        - data : Pandas DataFrame with models in columns and a 'GMFD' columns
-        - metric : Verification metric to be calculated.
-        - yearMin : First year of sample, defaults to earliest common year
-        - yearMax : Last year of sample, defaults to latest common year
+
+def prep_agvar(data, yearMin, yearMax):
     """
+    Filter and index AgVar data for verification, returning (data, models)
+    """
+    data = as_frame(data, yearMin, yearMax)
     # Set correct GEOID structure, filter by years
     data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
     data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
@@ -66,6 +77,56 @@ def AgVarVerify(data, metric, yearMin=1956, yearMax=2005):
     data.set_index(["AgVar", "GEOID"], inplace=True)
     # Drop NaNs - Check this!!!
     data = data.drop(columns='Year').dropna()
+    return data, data.columns[:-1]
+
+
+def prep_yield(data, yearMin, yearMax, min, gmfd, usda):
+    """
+    Filter and index yield data for verification, returning (data, models, yearMin)
+    """
+    # Set correct default for GMFD start year
+    if gmfd and yearMin == 1950:
+        yearMin = 1956
+    data = as_frame(data, yearMin, yearMax)
+    # Set correct GEOID structure, filter by years
+    data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
+    data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
+    # Set correct indexing structure
+    data.set_index(['GEOID'], inplace=True)
+    # Drop GEOIDS with too few observations
+    bad = data[usda*'USDA' + gmfd*'GMFD'].isna().groupby(level='GEOID').sum() > (yearMax - yearMin - min)
+    data = data.drop(bad[bad == True].index)
+    # Drop NaNs - Check this!!!
+    if usda:
+        data = data.drop(columns='Year').dropna()
+    elif gmfd:
+        data = data.drop(columns='Year')
+    # Models to verify
+    if gmfd:
+        models = data.columns.drop(['GMFD', 'USDA'])
+    elif usda:
+        models = data.columns.drop(['USDA'])
+    return data, models, yearMin
+
+
+def AgVarVerify(data, metric, yearMin=1956, yearMax=2005, n_jobs=1, shard='geoid'):
+    """
+    Calculate verification metrics of each ensemble member against GMFD truth
+
+    Inputs:
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
+        - metric : Verification metric to be calculated.
+        - yearMin : First year of sample, defaults to earliest common year
+        - yearMax : Last year of sample, defaults to latest common year
+        - n_jobs : Number of worker processes, sharding the counties (results match n_jobs=1 exactly)
+        - shard : Shard counties by 'geoid' or by 'state' FIPS prefix
+    """
+    # Filter years, set indexing and drop NaNs
+    data, models = prep_agvar(data, yearMin, yearMax)
+    # Vectorised metrics over the whole AgVar x GEOID x Year cube
+    if metric in VEC_METRICS:
+        cube = engine.make_cube(data)
+        return parallel.Verify(cube, metric, models, 'GMFD', n_jobs, shard)
     # Each DataSeries will be appended to 'res'
     res = []
     # Set correct grouping
@@ -73,49 +134,46 @@ def AgVarVerify(data, metric, yearMin=1956, yearMax=2005):
     # Read verification metric and assign correct 'myfunc'
     myfunc = globals()['new_' + metric]
     # Calculate verification metric
-    for model_name in data.columns[:-1]:
+    for model_name in models:
         res.append(dataGrouped.apply(myfunc, model_name, True, False))
     # Return DataFrame of metric for each model and GEOID
-    return pd.DataFrame(res, index=data.columns[:-1]).T
+    return pd.DataFrame(res, index=models).T
+
+
+def AgVarVerifyAll(data, metrics, yearMin=1956, yearMax=2005, tidy=False):
+    """
+    Calculate several verification metrics of each ensemble member against GMFD truth in one pass
+
+    Inputs:
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
+        - metrics : List of verification metrics to be calculated
+        - yearMin : First year of sample, defaults to earliest common year
+        - yearMax : Last year of sample, defaults to latest common year
+        - tidy : Return one long DataFrame instead of a dict of DataFrames
+    """
+    # Filter years, set indexing and drop NaNs
+    data, models = prep_agvar(data, yearMin, yearMax)
+    # Calculate all metrics from the same cube
+    res = verify_all(data, metrics, models, 'GMFD', True, False)
+    return to_tidy(res) if tidy else res
 
 
-def AgVarSPR(data, yearMin=1956, yearMax=2005):
+def AgVarSPR(data, yearMin=1956, yearMax=2005, n_jobs=1, shard='geoid'):
     """
     Calculate spread-skill ratio of ensemble whole against GMFD truth
 
     Inputs:
-        - data : Pandas DataFrame with models in columns and a 'GMFD' columns
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
         - yearMin : First year of sample, defaults to earliest common year
         - yearMax : Last year of sample, defaults to latest common year
+        - n_jobs : Number of worker processes, sharding the counties (results match n_jobs=1 exactly)
+        - shard : Shard counties by 'geoid' or by 'state' FIPS prefix
     """
-    # Set correct GEOID structure, filter by years
-    data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
-    data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
-    # Set correct indexing structure
-    data.set_index(["AgVar", "GEOID"], inplace=True)
-    # Drop NaNs - Check this!!!
-    data = data.drop(columns='Year').dropna()
-    # Each DataSeries will be appended to 'res'
-    res = []
-    # Set correct grouping
-    dataGrouped = data.groupby(['AgVar', 'GEOID'])
-    # Calculate STDs
-    for model_name in data.columns[:-1]:
-        if model_name == 'ensemble_mean':
-            res.append(dataGrouped.apply(new_rmse, model_name, True, False))
-        else:
-            res.append(dataGrouped.apply(spr_var, model_name))
-    # Set DataFrame of SPR for each model and GEOID
-    res = pd.DataFrame(res, index=data.columns[:-1]).T
-    # Get means of STD
-    std = res.drop(columns = ['ensemble_mean']).mean(axis = 1)
-    # Get RMSE of ensemble_mean
-    rmse = res.filter(['ensemble_mean'])
-    # Merge again
-    final = pd.merge(rmse, pd.DataFrame(std, index = std.index, columns = ['var']), on = ['AgVar', 'GEOID'])
-    # Return final
-    final['SPR'] = np.sqrt(final['var']) / final['ensemble_mean']
-    return final.drop(columns = ['var', 'ensemble_mean'])
+    # Filter years, set indexing and drop NaNs
+    data, models = prep_agvar(data, yearMin, yearMax)
+    # Spread of the members against skill of the ensemble mean
+    cube = engine.make_cube(data)
+    return spr(cube, models.drop(['ensemble_mean']), 'GMFD', n_jobs, shard)
 
 
 def AgVarCRPS(data, yearMin=1956, yearMax=2005):
@@ -123,69 +181,41 @@ def AgVarCRPS(data, yearMin=1956, yearMax=2005):
     Calculate Continuous Rank Probability Score of ensemble whole against GMFD truth
 
     Inputs:
-        - data : Pandas DataFrame with models in columns and a 'GMFD' columns
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
         - yearMin : First year of sample, defaults to earliest common year
         - yearMax : Last year of sample, defaults to latest common year
     """
-    # Set correct GEOID structure, filter by years
-    data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
-    data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
-    # Set correct indexing structure
-    data.set_index(["AgVar", "GEOID"], inplace=True)
-    # Drop NaNs - Check this!!!
-    data = data.drop(columns='Year').dropna()
-    # Each DataSeries will be appended to 'res'
-    res = []
-    # Set correct grouping
-    dataGrouped = data.groupby(['AgVar', 'GEOID'])
-    # Calculate STDs
-    for model_name in data.columns[:-2]:
-        if model_name == 'ensemble_mean':
-            res.append(dataGrouped.apply(new_rmse, model_name, True, False))
-        else:
-            res.append(dataGrouped.apply(spr_var, model_name))
-    # Set DataFrame of SPR for each model and GEOID
-    res = pd.DataFrame(res, index=data.columns[:-1]).T
-    # Get means of STD
-    std = res.drop(columns = ['ensemble_mean']).mean(axis = 1)
-    # Get RMSE of ensemble_mean
-    rmse = res.filter(['ensemble_mean'])
-    # Merge again
-    final = pd.merge(rmse, pd.DataFrame(std, index = std.index, columns = ['var']), on = ['AgVar', 'GEOID'])
-    # Return final
-    final['SPR'] = np.sqrt(final['var']) / final['ensemble_mean']
-    return final.drop(columns = ['var', 'ensemble_mean'])
-
-
-def YieldVerify(data, metric, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True):
+    # Filter years, set indexing and drop NaNs
+    data, models = prep_agvar(data, yearMin, yearMax)
+    # Ensemble members exclude the ensemble mean
+    members = models.drop(['ensemble_mean'])
+    # CRPS of every AgVar x GEOID x Year cell at once
+    crps = engine.crps_ensemble(data['GMFD'].to_numpy(dtype=float), data[members].to_numpy(dtype=float))
+    # Average over years
+    return pd.DataFrame({'CRPS': crps}, index=data.index).groupby(level=['AgVar', 'GEOID']).mean()
+
+
+def YieldVerify(data, metric, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True, n_jobs=1, shard='geoid'):
     """
     Calculate verification metrics of each ensemble member against GMFD or USDA truth
 
     Inputs:
-        - data : Pandas DataFrame with models in columns and a 'GMFD' columns
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
         - metric : Verification metric to be calculated. Choose from:
                     pearson, spearman, mse, mae, r2, sdR, madR
         - yearMin : First year of sample, defaults to earliest common year
         - yearMax : Last year of sample, defaults to latest common year
         - min: Minimum number of GMFD/USDA years required to calculate statistics
         - gmfd/usda : Dataset to verify against
+        - n_jobs : Number of worker processes, sharding the counties (results match n_jobs=1 exactly)
+        - shard : Shard counties by 'geoid' or by 'state' FIPS prefix
     """
-    # Set correct default for GMFD start year
-    if gmfd and yearMin == 1950:
-        yearMin = 1956
-    # Set correct GEOID structure, filter by years
-    data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
-    data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
-    # Set correct indexing structure
-    data.set_index(['GEOID'], inplace=True)
-    # Drop GEOIDS with too few observations
-    bad = data[usda*'USDA' + gmfd*'GMFD'].isna().sum(level='GEOID') > (yearMax - yearMin - min)
-    data = data.drop(bad[bad == True].index)
-    # Drop NaNs - Check this!!!
-    if usda:
-        data = data.drop(columns='Year').dropna()
-    elif gmfd:
-        data = data.drop(columns='Year')
+    # Filter years, drop sparse GEOIDs and NaNs
+    data, models, yearMin = prep_yield(data, yearMin, yearMax, min, gmfd, usda)
+    # Vectorised metrics over the whole GEOID x Year cube
+    if metric in VEC_METRICS:
+        cube = engine.make_cube(data)
+        return parallel.Verify(cube, metric, models, gmfd*'GMFD' + usda*'USDA', n_jobs, shard)
     # Each DataSeries will be appended to 'res'
     res = []
     # Set correct grouping
@@ -193,30 +223,75 @@ def YieldVerify(data, metric, yearMin=1950, yearMax=2005, min=40, gmfd=False, us
     # Read verification metric and assign correct 'myfunc'
     myfunc = globals()['new_' + metric]
     # Calculate verification metric
-    if gmfd:
-        models = data.columns.drop(['GMFD', 'USDA'])
-    elif usda:
-        models = data.columns.drop(['USDA'])
     for model_name in models:
         res.append(dataGrouped.apply(myfunc, model_name, gmfd, usda))
     # Return DataFrame of metric for each model and GEOID
     return pd.DataFrame(res, index=models).T
 
 
-def YieldSPR(data, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True):
+def YieldVerifyAll(data, metrics, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True, tidy=False):
+    """
+    Calculate several verification metrics of each ensemble member against GMFD or USDA truth in one pass
+
+    Inputs:
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
+        - metrics : List of verification metrics to be calculated, e.g. ['r2', 'rmse', 'sdratio']
+        - yearMin : First year of sample, defaults to earliest common year
+        - yearMax : Last year of sample, defaults to latest common year
+        - min: Minimum number of GMFD/USDA years required to calculate statistics
+        - gmfd/usda : Dataset to verify against
+        - tidy : Return one long DataFrame instead of a dict of DataFrames
+    """
+    # Filter years, drop sparse GEOIDs and NaNs
+    data, models, yearMin = prep_yield(data, yearMin, yearMax, min, gmfd, usda)
+    # Calculate all metrics from the same cube
+    res = verify_all(data, metrics, models, gmfd*'GMFD' + usda*'USDA', gmfd, usda)
+    return to_tidy(res) if tidy else res
+
+
+def verify_all(data, metrics, models, truth, gmfd, usda):
+    """
+    Calculate a dict of metric DataFrames from prepared data, sharing the moments
+    of all moment-based metrics and falling back to the groupby for the rest
+    """
+    cube = engine.make_cube(data)
+    vec = [metric for metric in metrics if metric in VEC_METRICS]
+    res = engine.VerifyMany(cube, vec, models, truth)
+    dataGrouped = data.groupby(data.index.names)
+    for metric in metrics:
+        if metric not in vec:
+            myfunc = globals()['new_' + metric]
+            res[metric] = pd.DataFrame([dataGrouped.apply(myfunc, model_name, gmfd, usda)
+                                        for model_name in models], index=models).T
+    return {metric: res[metric] for metric in metrics}
+
+
+def to_tidy(res):
+    """
+    Stack a dict of metric DataFrames into one long DataFrame with 'metric', 'model' and 'value' columns
+    """
+    tidy = pd.concat({metric: df.rename_axis(columns='model').stack() for metric, df in res.items()},
+                     names=['metric'])
+    return tidy.rename('value').reset_index()
+
+
+def YieldSPR(data, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True, n_jobs=1, shard='geoid'):
     """
     Calculate spread-skill ratio for whole ensemble against GMFD or USDA truth
 
     Inputs:
-        - data : Pandas DataFrame with models in columns and a 'GMFD' columns
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
         - yearMin : First year of sample, defaults to earliest common year
         - yearMax : Last year of sample, defaults to latest common year
         - min: Minimum number of GMFD/USDA years required to calculate statistics
         - gmfd/usda : Dataset to verify against
+        - n_jobs : Number of worker processes, sharding the counties (results match n_jobs=1 exactly)
+        - shard : Shard counties by 'geoid' or by 'state' FIPS prefix
     """
     # Set correct default for GMFD start year
     if gmfd and yearMin != 1950:
         yearMin = 1956
+    data = as_frame(data, yearMin, yearMax)
     # Set correct GEOID structure, filter by years
     data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
     data = data.query('Year >= ' + str(yearMin) + ' and Year <= ' + str(yearMax))
@@ -226,59 +301,61 @@ def YieldSPR(data, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True):
     elif usda:
         data.set_index(['GEOID'], inplace=True)
     # Drop GEOIDS with too few observations
-    bad = data[usda*'USDA' + gmfd*'GMFD'].isna().sum(level='GEOID') > (yearMax - yearMin - min)
+    bad = data[usda*'USDA' + gmfd*'GMFD'].isna().groupby(level='GEOID').sum() > (yearMax - yearMin - min)
     data = data.drop(bad[bad == True].index)
     # Drop NaNs - Check this!!!
     data = data.drop(columns='Year').dropna()
-    # Each DataSeries will be appended to 'res'
-    res = []
-    # Set correct grouping
-    if gmfd:
-        dataGrouped = data.groupby(['GEOID'])
-    elif usda:
-        dataGrouped = data.groupby(['GEOID'])
-    # Calculate verification metric
-    if gmfd:
-        models = data.columns.drop(['GMFD', 'USDA'])
-    elif usda:
-        models = data.columns.drop(['USDA'])
-   # Calculate STDs
-    for model_name in data.columns[:-1]:
-        if model_name == 'ensemble_mean':
-            res.append(dataGrouped.apply(new_rmse, model_name, gmfd, usda))
-        else:
-            res.append(dataGrouped.apply(spr_var, model_name))
-    # Set DataFrame of SPR for each model and GEOID
-    res = pd.DataFrame(res, index=data.columns[:-1]).T
-    # Get means of STD
-    std = res.drop(columns = ['ensemble_mean']).mean(axis = 1)
-    # Get RMSE of ensemble_mean
-    rmse = res.filter(['ensemble_mean'])
-    # Merge again
-    final = pd.merge(rmse, pd.DataFrame(std, index = std.index, columns = ['var']), on = ['GEOID'])
-    # Return final
-    final['SPR'] = np.sqrt(final['var']) / final['ensemble_mean']
-    return final.drop(columns = ['var', 'ensemble_mean'])
-
-
-def Ratio(nex, cmip):
+    # Spread of the members against skill of the ensemble mean
+    cube = engine.make_cube(data)
+    return spr(cube, data.columns[:-1].drop(['ensemble_mean']), gmfd*'GMFD' + usda*'USDA', n_jobs, shard)
+
+
+def spr(cube, members, truth, n_jobs=1, shard='geoid'):
+    """
+    Spread-skill ratio: square root of the mean member variance over the RMSE of the ensemble mean
+    """
+    var = parallel.Verify(cube, 'var', members, None, n_jobs, shard).mean(axis=1)
+    rmse = parallel.Verify(cube, 'rmse', ['ensemble_mean'], truth, n_jobs, shard)['ensemble_mean']
+    return pd.DataFrame({'SPR': np.sqrt(var) / rmse})
+
+
+def YieldCRPS(data, yearMin=1950, yearMax=2005, min=40, gmfd=False, usda=True):
+    """
+    Calculate Continuous Rank Probability Score of ensemble whole against GMFD or USDA truth
+
+    Inputs:
+        - data : Pandas DataFrame (or store.Store) with models in columns and a 'GMFD' columns
+        - yearMin : First year of sample, defaults to earliest common year
+        - yearMax : Last year of sample, defaults to latest common year
+        - min: Minimum number of GMFD/USDA years required to calculate statistics
+        - gmfd/usda : Dataset to verify against
+    """
+    # Filter years, drop sparse GEOIDs and NaNs
+    data, models, yearMin = prep_yield(data, yearMin, yearMax, min, gmfd, usda)
+    # Ensemble members exclude the ensemble mean and GMFD
+    members = models.drop(['ensemble_mean', 'GMFD'], errors='ignore')
+    # CRPS of every GEOID x Year cell at once
+    truth = data[gmfd*'GMFD' + usda*'USDA'].to_numpy(dtype=float)
+    crps = engine.crps_ensemble(truth, data[members].to_numpy(dtype=float))
+    # Average over years
+    return pd.DataFrame({'CRPS': crps}, index=data.index).groupby(level='GEOID').mean()
+
+
+def Ratio(nex, cmip, counties=None):
     """
     Calculates the ratio of two verification metrics for each model (NEX/CMIP)
 
     Inputs:
         nex: NEX DataFrame
         cmip: CMIP DataFrame
+        counties: CountyIndex to join on, defaults to the GEOIDs of both DataFrames
     """
-    # Merge
-    if 'AgVar' in nex.reset_index().columns:
-        data = pd.merge(nex, cmip, on=['AgVar', 'GEOID'], how='inner', suffixes=['_nex', '_cmip'])
-        data.set_index(['AgVar', 'GEOID'], inplace = True)
-    else:
-        data = pd.merge(nex, cmip, on=['GEOID'], how='inner', suffixes=['_nex', '_cmip'])
-        data.set_index(['GEOID'], inplace = True)
+    if counties is None:
+        counties = countyindex.CountyIndex(nex.index.get_level_values('GEOID').append(
+            cmip.index.get_level_values('GEOID')))
+    # Join by county position
+    rows_nex, rows_cmip = counties.join(nex, cmip)
     # Calculate ratios
-    for model in nex.columns:
-        data[model] = data[model + '_nex'] / data[model + '_cmip']
-        data.drop(columns=[model + '_nex', model + '_cmip'], inplace=True)
+    ratio = nex.to_numpy(dtype=float)[rows_nex] / cmip[nex.columns].to_numpy(dtype=float)[rows_cmip]
     # Return new DataFrame
-    return data
+    return pd.DataFrame(ratio, index=nex.index[rows_nex], columns=nex.columns)
@@ -0,0 +1,292 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import engine
+import kde
+import oos
+from countyindex import fips
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Per-county p-value tables, '<ensemble>_<stat>_pval_<period>.csv' and
+# '<ensemble>_<agvar>_<stat>_pval_<period>.csv'
+TAIL_PVALS = os.path.join(HERE, 'tail_pvals')
+NEX = os.path.join(HERE, '../combine/output/nex_yield_60-05.csv')
+CMIP = os.path.join(HERE, '../combine/output/cmip_yield_60-05.csv')
+NEX_AGVAR = os.path.join(HERE, '../combine/output/nex_agvar_hist.csv')
+CMIP_AGVAR = os.path.join(HERE, '../combine/output/cmip_agvar_all.csv')
+AGVARS = ['gdd', 'egdd', 'prcp']
+
+# Tail statistics, all computed from the same resamples
+STATS = ['sd', 'mad', 'iqr', '80qr', 'q01', 'q05', 'min', 'mean']
+
+# Tables of tail_pvals: (subdirectory, AgVars or None for yields, statistics, bandwidths)
+TABLES = [('', None, ['sd', 'mad', 'iqr', '80qr', 'min'], None),
+          ('', AGVARS, ['sd', 'mad'], None),
+          ('naive_bw', None, ['sd', 'iqr', '80qr', 'q01', 'q05', 'mean'], 'silverman')]
+
+# Counties resampled per chunk
+CHUNK = 64
+
+# Counties compared with an existing table, and the largest median p-value difference accepted
+CHECK_SAMPLE = 200
+CHECK_TOL = 0.05
+
+
+def _quantile(s, n, q):
+    # Quantile q (linear interpolation, as np.quantile) along the last axis of sorted,
+    # NaN-padded samples with n valid values
+    pos = q * (n - 1)
+    lo = np.floor(pos).astype(np.intp)
+    hi = np.minimum(lo + 1, n - 1)
+    frac = pos - lo
+    lo_v = np.take_along_axis(s, np.maximum(lo, 0)[..., None], axis=-1)[..., 0]
+    hi_v = np.take_along_axis(s, np.maximum(hi, 0)[..., None], axis=-1)[..., 0]
+    return lo_v + frac * (hi_v - lo_v)
+
+
+def tail_stats(x, stats=STATS):
+    """
+    Tail statistics along the last axis of NaN-padded samples, for all leading axes at once
+
+    The samples are sorted once and every quantile read from the sorted values; 'mad' is the
+    median absolute deviation from the median and 'sd' the population standard deviation.
+
+    Inputs:
+        - x : Array (..., samples), NaN where missing
+        - stats : Statistics to compute, see STATS
+    Returns a dict of statistic name to array (...)
+    """
+    s = np.sort(x, axis=-1)
+    n = (~np.isnan(s)).sum(axis=-1)
+    res = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(s, axis=-1) / n
+        for stat in stats:
+            if stat == 'mean':
+                res[stat] = mean
+            elif stat == 'sd':
+                res[stat] = np.sqrt(np.nansum((s - mean[..., None]) ** 2, axis=-1) / n)
+            elif stat == 'mad':
+                dev = np.sort(np.abs(s - _quantile(s, n, 0.5)[..., None]), axis=-1)
+                res[stat] = _quantile(dev, n, 0.5)
+            elif stat == 'iqr':
+                res[stat] = _quantile(s, n, 0.75) - _quantile(s, n, 0.25)
+            elif stat == '80qr':
+                res[stat] = _quantile(s, n, 0.9) - _quantile(s, n, 0.1)
+            elif stat == 'min':
+                res[stat] = s[..., 0]
+            elif stat[0] == 'q':
+                res[stat] = _quantile(s, n, int(stat[1:]) / 100.)
+            else:
+                raise ValueError('Unknown statistic ' + stat)
+    return {stat: np.where(n > 0, value, np.nan) for stat, value in res.items()}
+
+
+def pvalues(observed, boot, alternative='two-sided'):
+    """
+    Bootstrap p-values of observed statistics (rows,) against their resampled values
+    (rows, resamples), (1 + count) / (1 + resamples) with the count of resamples at least
+    as extreme. 'alternative' is 'less', 'greater' or 'two-sided' (twice the smaller tail)
+    """
+    n_boot = (~np.isnan(boot)).sum(axis=1)
+    less = (1. + (boot <= observed[:, None]).sum(axis=1)) / (1. + n_boot)
+    greater = (1. + (boot >= observed[:, None]).sum(axis=1)) / (1. + n_boot)
+    res = {'less': less, 'greater': greater, 'two-sided': np.minimum(1., 2. * np.minimum(less, greater))}
+    return np.where(np.isnan(observed) | (n_boot == 0), np.nan, res[alternative])
+
+
+def _draws(geoids, n_obs, n_boot, seed):
+    # Uniform resample positions and kernel noise of each county, from its own seeded generator
+    u = np.empty((len(geoids), n_boot, n_obs))
+    z = np.empty((len(geoids), n_boot, n_obs))
+    for i, geoid in enumerate(geoids):
+        rng = np.random.default_rng([seed, int(geoid)])
+        u[i] = rng.random((n_boot, n_obs))
+        z[i] = rng.standard_normal((n_boot, n_obs))
+    return u, z
+
+
+def _work(args):
+    # Observed and bootstrap p-values of every statistic and ensemble for one chunk of counties
+    geoids, samples, bandwidths, obs, stats, n_boot, seed, alternative = args
+    valid = ~np.isnan(obs)
+    observed = tail_stats(obs, stats)
+    u, z = _draws(geoids, obs.shape[1], n_boot, seed)
+    res = []
+    for x, bw in zip(samples, bandwidths):
+        n = (~np.isnan(x)).sum(axis=1)
+        # Same draws for every ensemble, scaled to its number of members
+        pos = np.minimum((u * n[:, None, None]).astype(np.intp), np.maximum(n - 1, 0)[:, None, None])
+        boot = np.take_along_axis(x[:, None, :], pos.reshape(len(x), 1, -1), axis=2).reshape(u.shape)
+        boot = np.where(valid[:, None, :], boot + bw[:, None, None] * z, np.nan)
+        stat_boot = tail_stats(boot, stats)
+        res.append({stat: pvalues(observed[stat], stat_boot[stat], alternative) for stat in stats})
+    return observed, res
+
+
+def _pvals(data, truth, stats, n_boot, bandwidths, seed, alternative, geoids, n_jobs):
+    # Tables of every ensemble and statistic for one set of combined tables (dict of name to
+    # frame with GEOID, Year and member columns), keyed by (name, stat)
+    names = list(data)
+    first = data[names[0]]
+    keep = pd.Index(first['GEOID'].unique())
+    for name in names[1:]:
+        keep = keep.intersection(data[name]['GEOID'].unique())
+    if geoids is not None:
+        keep = keep.intersection(fips(geoids))
+    keep = keep.sort_values()
+
+    # Ensemble samples, kernel bandwidths and observations aligned on the counties
+    samples, bws = [], []
+    for name in names:
+        index, x = kde.ensemble_samples(data[name][data[name]['GEOID'].isin(keep)])
+        samples.append(x[index.get_indexer(keep)])
+        if bandwidths is None:
+            bws.append(np.zeros(len(keep)))
+        elif isinstance(bandwidths, str) and bandwidths == 'silverman':
+            bws.append(kde.silverman(samples[-1]))
+        else:
+            bws.append(bandwidths[name + '_bw'].reindex(keep).to_numpy(dtype=float))
+    cube = engine.make_cube(first[first['GEOID'].isin(keep)].set_index('GEOID'), [truth])
+    obs = np.where(cube.mask, cube.column(truth), np.nan)[cube.index.get_indexer(keep)]
+
+    chunks = [(start, min(start + CHUNK, len(keep))) for start in range(0, len(keep), CHUNK)]
+    args = [(keep[a:b], [x[a:b] for x in samples], [bw[a:b] for bw in bws], obs[a:b], list(stats), n_boot,
+             seed, alternative) for a, b in chunks]
+    if n_jobs == 1:
+        res = list(map(_work, args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(_work, args))
+
+    tables = {}
+    for e, name in enumerate(names):
+        for stat in stats:
+            tables[(name, stat)] = pd.DataFrame({
+                'GEOID': keep,
+                'obs': np.concatenate([r[0][stat] for r in res]) if res else [],
+                'pval': np.concatenate([r[1][e][stat] for r in res]) if res else []})
+    return tables
+
+
+def read_table(path):
+    """
+    Read a tail_pvals table as a Series of p-values indexed by 5 character GEOID
+
+    The p-value column is the one named like 'pval'. Raises ValueError for files that are
+    not p-value tables, such as git-lfs pointers of tables not fetched.
+    """
+    data = pd.read_csv(path, dtype={'GEOID': str})
+    cols = [col for col in data.columns if col.lower().replace('_', '').startswith('pval')]
+    if 'GEOID' not in data.columns or not cols:
+        raise ValueError(path + ' is not a p-value table (a git-lfs pointer not fetched?)')
+    return pd.Series(data[cols[0]].to_numpy(dtype=float), index=fips(data['GEOID']).rename('GEOID'))
+
+
+def compare(table, path, sample=CHECK_SAMPLE, seed=0):
+    """
+    Median absolute difference between the p-values of a table from TailPvals and an existing
+    tail_pvals table, over a sample of their common counties
+
+    Bootstrap p-values of different runs differ by their Monte Carlo error only, well below
+    CHECK_TOL, while a different convention (e.g. one- and two-sided) moves them by far more.
+    Returns NaN without common counties.
+    """
+    old = read_table(path)
+    new = pd.Series(table['pval'].to_numpy(dtype=float), index=fips(table['GEOID']))
+    common = new.index.intersection(old.index)
+    common = common[~(np.isnan(new[common].to_numpy()) | np.isnan(old[common].to_numpy()))]
+    if len(common) > sample:
+        common = common[np.sort(np.random.default_rng(seed).choice(len(common), sample, replace=False))]
+    if not len(common):
+        return np.nan
+    return float(np.median(np.abs(new[common].to_numpy() - old[common].to_numpy())))
+
+
+def TailPvals(ensembles=None, truth=None, yearMin=1960, yearMax=2005, stats=STATS, n_boot=1000,
+              bandwidths=None, seed=0, alternative='two-sided', geoids=None, path=TAIL_PVALS, n_jobs=1,
+              agvars=None, overwrite=False):
+    """
+    Bootstrap p-values of the tail statistics of the observations of every county against
+    each ensemble, written as one table per ensemble, AgVar and statistic in a single run
+
+    For each county the observed years are resampled from the pooled ensemble members
+    'n_boot' times. Resample positions come from a generator seeded by 'seed' and the GEOID,
+    so results do not depend on chunking or 'n_jobs', and all ensembles, AgVars and statistics
+    share the same draws. Statistics are computed along the resample axis in batches of
+    counties, spread over 'n_jobs' worker processes.
+
+    Existing tables are only replaced if their p-values agree with the new ones on a sample of
+    counties (see compare), so a run under another convention never overwrites them silently.
+
+    Inputs:
+        - ensembles : Dict of ensemble name to combined table (DataFrame, CSV path or
+                      store.Store), the NEX and CMIP 1960-2005 yield tables (or AgVar tables
+                      with 'agvars') if None
+        - truth : Observation column, 'USDA' for yields and 'GMFD' for AgVars if None
+        - yearMin/yearMax : Window of years
+        - stats : Statistics to test, see STATS
+        - n_boot : Number of resamples
+        - bandwidths : None for resampling the members as they are, 'silverman' for a smoothed
+                       bootstrap with each county's Silverman bandwidth (the naive_bw tables),
+                       or a DataFrame indexed by GEOID with '<name>_bw' columns (kde.read_bandwidths)
+        - seed : Seed of the resampling
+        - alternative : 'two-sided', 'less' or 'greater', see pvalues
+        - geoids : Counties to test, all if None
+        - path : Directory to write '<name>_<stat>_pval_<period>.csv' tables (GEOID, obs, pval)
+                 to, '<name>_<agvar>_<stat>_pval_<period>.csv' for AgVars, not written if None.
+                 The 'silverman' tables go to its naive_bw subdirectory
+        - n_jobs : Number of worker processes
+        - agvars : AgVars to test (e.g. AGVARS) in combined AgVar tables with an 'AgVar'
+                   column or dimension, yield tables if None
+        - overwrite : Replace existing tables without comparing them
+    Returns a dict of (name, stat), or (name, agvar, stat) with 'agvars', to the tables
+    """
+    if ensembles is None:
+        ensembles = {'nex': NEX, 'cmip': CMIP} if agvars is None else {'nex': NEX_AGVAR, 'cmip': CMIP_AGVAR}
+    if truth is None:
+        truth = 'USDA' if agvars is None else 'GMFD'
+    data = {name: oos.read_yields(table, yearMin, yearMax) for name, table in ensembles.items()}
+    if agvars is None:
+        groups = {(): data}
+    else:
+        groups = {(agvar,): {name: frame[frame['AgVar'] == agvar].drop(columns='AgVar') for name, frame in data.items()}
+                  for agvar in agvars}
+    tables = {}
+    for key, group in groups.items():
+        res = _pvals(group, truth, stats, n_boot, bandwidths, seed, alternative, geoids, n_jobs)
+        tables.update({(name,) + key + (stat,): table for (name, stat), table in res.items()})
+
+    if path is not None:
+        if isinstance(bandwidths, str) and bandwidths == 'silverman':
+            path = os.path.join(path, 'naive_bw')
+        period = '%02d-%02d' % (yearMin % 100, yearMax % 100)
+        files = {key: os.path.join(path, '_'.join(key) + '_pval_' + period + '.csv') for key in tables}
+        # Check every existing table before writing any
+        if not overwrite:
+            for key, file in files.items():
+                if os.path.exists(file):
+                    diff = compare(tables[key], file)
+                    if diff > CHECK_TOL:
+                        raise ValueError('P-values differ from ' + file + ' by %.3g (median over counties), '
+                                         'pass overwrite=True to replace it' % diff)
+        os.makedirs(path, exist_ok=True)
+        for key, file in files.items():
+            tables[key].to_csv(file, index=False)
+    return tables
+
+
+def AllTailPvals(path=TAIL_PVALS, n_boot=1000, seed=0, n_jobs=1, overwrite=False):
+    """
+    Write every tail_pvals table of TABLES in one run (yields, AgVars and the naive_bw variant)
+
+    Inputs as in TailPvals. Returns a dict of (directory, key) to the tables, the keys as in TailPvals
+    """
+    tables = {}
+    for directory, agvars, stats, bandwidths in TABLES:
+        res = TailPvals(stats=stats, n_boot=n_boot, bandwidths=bandwidths, seed=seed, path=path, n_jobs=n_jobs,
+                        agvars=agvars, overwrite=overwrite)
+        tables.update({(directory, key): table for key, table in res.items()})
+    return tables
@@ -0,0 +1,112 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Contiguous US county shapefile shared by the grid, analysis and plotting steps
+COUNTY_SHP = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          '../../data/conus_shp/conus/contig_county/counties_contig.shp')
+
+# Longitude of the east/west split of the yield response functions (260E)
+EAST_WEST_LON = -100.
+
+
+def fips(geoids):
+    """
+    Return GEOIDs (strings or integers) as 5 character FIPS strings
+    """
+    return pd.Index(geoids).astype(str).str.zfill(5)
+
+
+class CountyIndex:
+    """
+    Dense integer index of counties, mapping FIPS codes to positions 0..n-1
+
+    Attributes:
+        - geoids : Sorted Index of 5 character GEOIDs, position i is county i
+        - state : int8 array of state FIPS codes
+        - east : boolean array, True for counties east of EAST_WEST_LON
+    """
+
+    def __init__(self, geoids, east=None):
+        self.geoids = fips(geoids).unique().sort_values()
+        self.state = self.geoids.str[:2].astype(int).to_numpy(dtype=np.int8)
+        if east is None:
+            self.east = np.zeros(len(self.geoids), dtype=bool)
+        else:
+            self.east = pd.Series(np.asarray(east, dtype=bool), index=fips(geoids)).groupby(level=0).first()
+            self.east = self.east.reindex(self.geoids, fill_value=False).to_numpy()
+
+    def __len__(self):
+        return len(self.geoids)
+
+    @classmethod
+    def from_shapefile(cls, path=COUNTY_SHP):
+        """
+        Build the index from a county shapefile with a 'GEOID' column in lon/lat coordinates
+        """
+        import geopandas as gp
+        counties = gp.read_file(path)
+        bounds = counties.geometry.bounds
+        return cls(counties['GEOID'], (bounds['minx'] + bounds['maxx']) / 2. >= EAST_WEST_LON)
+
+    def positions(self, geoids):
+        """
+        Return the int32 positions of GEOIDs, -1 where the county is not in the index
+        """
+        return self.geoids.get_indexer(fips(geoids)).astype(np.int32)
+
+    def align(self, data, fill=np.nan):
+        """
+        Scatter a DataFrame or Series indexed by GEOID into a dense (counties, columns) array
+
+        Inputs:
+            - data : Pandas DataFrame/Series with a 'GEOID' index (level)
+            - fill : Value for counties missing from 'data'
+        """
+        pos = self.positions(data.index.get_level_values('GEOID'))
+        values = np.asarray(data, dtype=float)
+        out = np.full((len(self),) + values.shape[1:], fill)
+        keep = pos >= 0
+        out[pos[keep]] = values[keep]
+        return out
+
+    def join(self, left, right):
+        """
+        Inner join two frames on their GEOID or (AgVar, GEOID) index by county position
+
+        Returns the row positions (left_rows, right_rows) of the matching keys, in the
+        order of the left frame. Counties outside the index never match. The keys of the
+        right frame must be unique, raises ValueError otherwise.
+        """
+        keys_left = self.positions(left.index.get_level_values('GEOID')).astype(np.int64)
+        keys_right = self.positions(right.index.get_level_values('GEOID')).astype(np.int64)
+        # Fold any other index levels (e.g. AgVar) into the integer keys
+        others = [name for name in left.index.names if name != 'GEOID']
+        if others:
+            both = pd.concat([left.index.to_frame(index=False)[others],
+                              right.index.to_frame(index=False)[others]])
+            codes, _ = pd.MultiIndex.from_frame(both).factorize()
+            keys_left = np.where(keys_left >= 0, codes[:len(left)] * len(self) + keys_left, -1)
+            keys_right = np.where(keys_right >= 0, codes[len(left):] * len(self) + keys_right, -1)
+        valid = np.flatnonzero(keys_right >= 0)
+        right_keys = pd.Index(keys_right[valid])
+        if not right_keys.is_unique:
+            dup = right.index[valid[right_keys.duplicated()]].get_level_values('GEOID').unique()
+            raise ValueError('Duplicate keys in the right frame for GEOIDs ' + ', '.join(map(str, dup[:10]))
+                             + (' ...' if len(dup) > 10 else ''))
+        match = right_keys.get_indexer(keys_left)
+        left_rows = np.flatnonzero((match >= 0) & (keys_left >= 0))
+        return left_rows, valid[match[left_rows]]
+
+
+_COUNTIES = None
+
+
+def load_counties(path=COUNTY_SHP):
+    """
+    Return the shared CountyIndex, reading the shapefile only on the first call
+    """
+    global _COUNTIES
+    if _COUNTIES is None:
+        _COUNTIES = CountyIndex.from_shapefile(path)
+    return _COUNTIES
@@ -0,0 +1,345 @@
+import numpy as np
+import pandas as pd
+
+
+class Cube:
+    """
+    Dense (group, sample, column) array of a long-format DataFrame
+
+    Attributes:
+        - values : float array of shape (groups, samples, columns). Empty slots are NaN
+        - mask : boolean array of shape (groups, samples), True where a row was present
+        - index : Index/MultiIndex of the groups, sorted as in a pandas groupby
+        - columns : Index of the stacked columns
+    """
+
+    def __init__(self, values, mask, index, columns):
+        self.values = values
+        self.mask = mask
+        self.index = index
+        self.columns = pd.Index(columns)
+
+    def column(self, name):
+        """Return the (groups, samples) slice of one column"""
+        return self.values[:, :, self.columns.get_loc(name)]
+
+    def columns_of(self, names):
+        """Return the (groups, samples, len(names)) slice of several columns"""
+        return self.values[:, :, self.columns.get_indexer(names)]
+
+
+def make_cube(data, columns=None):
+    """
+    Turn a long-format DataFrame into a dense Cube, grouped by its index
+
+    Each row of 'data' becomes one sample of its group, so the sample axis holds
+    the years of a county (or AgVar/county pair) in their original order.
+
+    Inputs:
+        - data : Pandas DataFrame indexed by the grouping keys (e.g. GEOID or AgVar, GEOID)
+        - columns : Columns to stack, defaults to all columns
+    """
+    if columns is None:
+        columns = data.columns
+    # Group codes, sorted like a groupby
+    codes, index = data.index.factorize(sort=True)
+    index.names = data.index.names
+    # Position of each row within its group
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(index))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    position = np.empty(len(codes), dtype=np.intp)
+    position[order] = np.arange(len(codes)) - np.repeat(starts, counts)
+    # Fill the dense array
+    n_samples = counts.max() if len(counts) > 0 else 0
+    values = np.full((len(index), n_samples, len(columns)), np.nan)
+    values[codes, position] = data[columns].to_numpy(dtype=float)
+    mask = np.zeros((len(index), n_samples), dtype=bool)
+    mask[codes, position] = True
+    return Cube(values, mask, index, columns)
+
+
+def _count(mask):
+    return mask.sum(axis=1)[:, None]
+
+
+def _mean(x, mask, n):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(mask[:, :, None], x, 0.).sum(axis=1) / n
+
+
+def _centre(x, mask, n):
+    return np.where(mask[:, :, None], x - _mean(x, mask, n)[:, None, :], 0.)
+
+
+def _expand(obs, sim):
+    # Broadcast the observations against every model
+    return np.broadcast_to(obs[:, :, None], sim.shape)
+
+
+def vec_r2(obs, sim, mask):
+    n = _count(mask)
+    obs = _expand(obs, sim)
+    ss_res = np.where(mask[:, :, None], (obs - sim) ** 2, 0.).sum(axis=1)
+    ss_tot = (_centre(obs, mask, n) ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = 1. - ss_res / ss_tot
+    # Follow sklearn for constant truth and too few samples
+    res = np.where(ss_tot == 0., np.where(ss_res == 0., 1., 0.), res)
+    return np.where(n < 2, np.nan, res)
+
+
+def vec_mse(obs, sim, mask):
+    n = _count(mask)
+    return _mean((_expand(obs, sim) - sim) ** 2, mask, n)
+
+
+def vec_rmse(obs, sim, mask):
+    return np.sqrt(vec_mse(obs, sim, mask))
+
+
+def vec_mae(obs, sim, mask):
+    n = _count(mask)
+    return _mean(np.abs(_expand(obs, sim) - sim), mask, n)
+
+
+def vec_pearson(obs, sim, mask):
+    n = _count(mask)
+    dx = _centre(_expand(obs, sim), mask, n)
+    dy = _centre(sim, mask, n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = (dx * dy).sum(axis=1) / np.sqrt((dx ** 2).sum(axis=1) * (dy ** 2).sum(axis=1))
+    res = np.clip(res, -1., 1.)
+    return np.where(n < 2, np.nan, res)
+
+
+def vec_sdratio(obs, sim, mask):
+    n = _count(mask)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd_sim = np.sqrt(_mean(_centre(sim, mask, n) ** 2, mask, n))
+        sd_obs = np.sqrt(_mean(_centre(_expand(obs, sim), mask, n) ** 2, mask, n))
+        return sd_sim / sd_obs
+
+
+def vec_var(sim, mask):
+    n = _count(mask)
+    return _mean(_centre(sim, mask, n) ** 2, mask, n)
+
+
+def _has_nan(x, mask):
+    # Samples that are present but NaN propagate, as in numpy and scipy
+    return (np.isnan(x) & mask[:, :, None]).any(axis=1)
+
+
+def _median(x, mask):
+    """
+    Median along the sample axis of x (groups, samples, models) over valid samples
+    """
+    s = np.sort(np.where(mask[:, :, None], x, np.nan), axis=1)
+    n = (mask[:, :, None] & ~np.isnan(x)).sum(axis=1)[:, None, :]
+    lo = np.take_along_axis(s, np.maximum(n - 1, 0) // 2, axis=1)[:, 0]
+    hi = np.take_along_axis(s, np.minimum(n // 2, s.shape[1] - 1), axis=1)[:, 0]
+    res = (lo + hi) / 2.
+    return np.where((n[:, 0] == 0) | _has_nan(x, mask), np.nan, res)
+
+
+def _rank(x, mask):
+    """
+    Ranks along the sample axis of x (groups, samples, models), averaging ties
+    like scipy.stats.rankdata. Invalid samples are ranked last and should stay masked.
+    """
+    v = np.where(mask[:, :, None], x, np.inf)
+    order = np.argsort(v, axis=1, kind='stable')
+    s = np.take_along_axis(v, order, axis=1)
+    idx = np.arange(s.shape[1])[None, :, None]
+    # First and last position of each run of tied values
+    new = np.ones(s.shape, dtype=bool)
+    new[:, 1:] = s[:, 1:] != s[:, :-1]
+    end = np.ones(s.shape, dtype=bool)
+    end[:, :-1] = new[:, 1:]
+    first = np.maximum.accumulate(np.where(new, idx, 0), axis=1)
+    last = np.minimum.accumulate(np.where(end, idx, s.shape[1])[:, ::-1], axis=1)[:, ::-1]
+    ranks = np.empty(s.shape)
+    np.put_along_axis(ranks, order, (first + last) / 2. + 1., axis=1)
+    return ranks
+
+
+def vec_mdae(obs, sim, mask):
+    return _median(np.abs(_expand(obs, sim) - sim), mask)
+
+
+def vec_spearman(obs, sim, mask):
+    rank_obs = _rank(obs[:, :, None], mask)[:, :, 0]
+    res = vec_pearson(rank_obs, _rank(sim, mask), mask)
+    return np.where(_has_nan(sim, mask) | _has_nan(obs[:, :, None], mask), np.nan, res)
+
+
+def _mad(x, mask):
+    return _median(np.abs(x - _median(x, mask)[:, None, :]), mask)
+
+
+def vec_madratio(obs, sim, mask):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _mad(sim, mask) / _mad(obs[:, :, None], mask)
+
+
+def compute(cube, metric, models, truth=None):
+    """
+    Return the (groups, models) array of a metric, or of the model variance if metric is 'var'
+    """
+    if metric == 'var':
+        return vec_var(cube.columns_of(models), cube.mask)
+    myfunc = globals()['vec_' + metric]
+    return myfunc(cube.column(truth), cube.columns_of(models), cube.mask)
+
+
+def Verify(cube, metric, models, truth):
+    """
+    Calculate a verification metric for every group and model at once
+
+    Inputs:
+        - cube : Cube built with make_cube
+        - metric : Verification metric, one of r2, mse, rmse, mae, mdae, pearson, spearman,
+                   sdratio, madratio, or 'var' for the model variance
+        - models : Columns of the cube to verify
+        - truth : Column of the cube to verify against
+    """
+    res = compute(cube, metric, models, truth)
+    return pd.DataFrame(res, index=cube.index, columns=pd.Index(models))
+
+
+class Moments:
+    """
+    Sufficient statistics of observations x and models y for every group
+
+    Attributes:
+        - n : number of samples, shape (groups, 1)
+        - sx, sxx : sums of x and x^2, shape (groups, 1)
+        - sy, syy, sxy : sums of y, y^2 and x*y, shape (groups, models)
+        - shift : per-group constant subtracted from x and y before summing, which
+                  keeps the sums well conditioned and leaves every metric unchanged
+    """
+
+    def __init__(self, n, sx, sy, sxx, syy, sxy, shift):
+        self.n = n
+        self.sx = sx
+        self.sy = sy
+        self.sxx = sxx
+        self.syy = syy
+        self.sxy = sxy
+        self.shift = shift
+
+
+def make_moments(obs, sim, mask, shift=None):
+    """
+    Accumulate the Moments of a cube in one pass
+
+    Inputs:
+        - obs : (groups, samples) array of observations
+        - sim : (groups, samples, models) array of model values
+        - mask : (groups, samples) boolean array of valid samples
+        - shift : (groups, 1) array to subtract, defaults to the mean of the observations
+    """
+    n = _count(mask)
+    if shift is None:
+        shift = _mean(obs[:, :, None], mask, n)
+    x = np.where(mask, obs - shift, 0.)[:, :, None]
+    y = np.where(mask[:, :, None], sim - shift[:, :, None], 0.)
+    return Moments(n, x.sum(axis=1), y.sum(axis=1), (x ** 2).sum(axis=1),
+                   (y ** 2).sum(axis=1), (x * y).sum(axis=1), shift)
+
+
+def _ss_x(m):
+    return m.sxx - m.sx ** 2 / m.n
+
+
+def _ss_y(m):
+    return m.syy - m.sy ** 2 / m.n
+
+
+def _ss_res(m):
+    return m.sxx - 2. * m.sxy + m.syy
+
+
+def mom_mse(m):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return _ss_res(m) / m.n
+
+
+def mom_rmse(m):
+    return np.sqrt(mom_mse(m))
+
+
+def mom_r2(m):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ss_res = _ss_res(m)
+        ss_tot = np.broadcast_to(_ss_x(m), ss_res.shape)
+        res = 1. - ss_res / ss_tot
+    res = np.where(ss_tot == 0., np.where(ss_res == 0., 1., 0.), res)
+    return np.where(m.n < 2, np.nan, res)
+
+
+def mom_pearson(m):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        res = (m.sxy - m.sx * m.sy / m.n) / np.sqrt(_ss_x(m) * _ss_y(m))
+    res = np.clip(res, -1., 1.)
+    return np.where(m.n < 2, np.nan, res)
+
+
+def mom_sdratio(m):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(np.maximum(_ss_y(m), 0.) / np.maximum(_ss_x(m), 0.))
+
+
+def mom_var(m):
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.maximum(_ss_y(m), 0.) / m.n
+
+
+# Metrics derived from Moments alone
+MOMENT_METRICS = ['r2', 'mse', 'rmse', 'pearson', 'sdratio']
+
+
+def VerifyMany(cube, metrics, models, truth):
+    """
+    Calculate several verification metrics from one pass over the cube
+
+    Moment-based metrics share a single set of Moments, the rest are reduced
+    directly from the cube.
+
+    Inputs:
+        - cube : Cube built with make_cube
+        - metrics : List of verification metrics
+        - models : Columns of the cube to verify
+        - truth : Column of the cube to verify against
+    """
+    obs = cube.column(truth)
+    sim = cube.columns_of(models)
+    res = {}
+    if any(metric in MOMENT_METRICS for metric in metrics):
+        mom = make_moments(obs, sim, cube.mask)
+    for metric in metrics:
+        if metric in MOMENT_METRICS:
+            values = globals()['mom_' + metric](mom)
+        else:
+            values = globals()['vec_' + metric](obs, sim, cube.mask)
+        res[metric] = pd.DataFrame(values, index=cube.index, columns=pd.Index(models))
+    return res
+
+
+def crps_ensemble(obs, ens):
+    """
+    Continuous Ranked Probability Score of an ensemble forecast for every cell
+
+    Uses the sorted-ensemble form, O(m log m) per cell for m members:
+        CRPS = mean|x_i - y| - 1/m^2 sum_i (2i - m - 1) x_(i)
+
+    Inputs:
+        - obs : (cells,) array of observations
+        - ens : (cells, members) array of ensemble members
+    """
+    m = ens.shape[1]
+    ens = np.sort(ens, axis=1)
+    weights = 2. * np.arange(1, m + 1) - m - 1
+    spread = ens @ weights / m ** 2
+    return np.abs(ens - obs[:, None]).mean(axis=1) - spread
@@ -0,0 +1,188 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import engine
+from countyindex import fips
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Chosen KDE bandwidths of every county and ensemble, replacing analysis/bw_final.txt
+BANDWIDTHS = os.path.join(HERE, 'output/kde_bandwidths.csv')
+
+# Columns of the combined yield tables that are not ensemble members
+NON_MEMBERS = ['Year', 'GMFD', 'USDA', 'ensemble_mean']
+
+# Number of (county, bandwidth, sample, sample) kernel evaluations held in memory at once
+BLOCK = 2 ** 24
+
+
+def ensemble_samples(data, exclude=NON_MEMBERS):
+    """
+    Pool the ensemble members of every county into one padded sample, as the flattened
+    members of OOS_Likelihood.ipynb
+
+    Inputs:
+        - data : Pandas DataFrame of a combined yield table with a 'GEOID' column or index
+        - exclude : Columns that are not ensemble members
+    Returns (Index of GEOIDs, array (counties, samples) NaN-padded after each county's values)
+    """
+    if 'GEOID' in data.columns:
+        data = data.set_index('GEOID')
+    data = data.set_axis(fips(data.index.get_level_values('GEOID')).rename('GEOID'), axis=0)
+    members = [col for col in data.columns if col not in exclude]
+    cube = engine.make_cube(data, members)
+    x = np.where(cube.mask[:, :, None], cube.values, np.nan).reshape(len(cube.index), -1)
+    # Valid values first, in their order, so padding is at the end
+    order = np.argsort(np.isnan(x), axis=1, kind='stable')
+    x = np.take_along_axis(x, order, axis=1)
+    return cube.index, x[:, :max(int((~np.isnan(x)).sum(axis=1).max(initial=0)), 1)]
+
+
+def silverman(x):
+    """
+    Silverman's rule of thumb bandwidth of each row of a NaN-padded sample array,
+    0.9 min(sd, iqr / 1.34) n^-0.2
+    """
+    n = (~np.isnan(x)).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sd = np.nanstd(x, axis=1)
+        iqr = np.subtract(*np.nanquantile(x, [0.75, 0.25], axis=1))
+        return 0.9 * np.fmin(sd, iqr / 1.34) * n ** -0.2
+
+
+def bandwidth_grid(x, num=30, lo=0.5, hi=3.):
+    """
+    Bandwidths tried for each row of 'x', 'num' values from 'lo' to 'hi' times its
+    Silverman bandwidth as in OOS_Likelihood.ipynb. Returns an array (rows, num)
+    """
+    return silverman(x)[:, None] * np.linspace(lo, hi, num)[None, :]
+
+
+def loo_loglik(x, bandwidths):
+    """
+    Leave-one-out log-likelihood of Gaussian KDEs for every row and bandwidth at once
+
+    Each point is scored by the KDE of the other points of its row,
+        log f_-i(x_i) = log sum_{j != i} exp(-(x_i - x_j)^2 / 2h^2) - log((n - 1) h sqrt(2 pi)),
+    the sums taken relative to each point's nearest neighbour so they never underflow.
+
+    Inputs:
+        - x : Array (rows, samples), NaN-padded
+        - bandwidths : Array (rows, bandwidths)
+    Returns the summed log-likelihoods as an array (rows, bandwidths), NaN for rows with
+    fewer than 2 values
+    """
+    valid = ~np.isnan(x)
+    n = valid.sum(axis=1)
+    pair = valid[:, :, None] & valid[:, None, :] & ~np.eye(x.shape[1], dtype=bool)
+    d2 = np.where(pair, (x[:, :, None] - x[:, None, :]) ** 2, np.inf)
+    nearest = d2.min(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        scale = -0.5 / bandwidths ** 2
+        # (rows, bandwidths, samples, samples) kernel sums, nearest neighbour factored out
+        sums = np.exp(scale[:, :, None, None] * (d2 - np.where(np.isinf(nearest), 0., nearest))[:, None]).sum(axis=3)
+        log_f = (scale[:, :, None] * nearest[:, None, :, 0] + np.log(sums)
+                 - np.log((n[:, None, None] - 1) * bandwidths[:, :, None] * np.sqrt(2. * np.pi)))
+        res = np.where(valid[:, None, :], log_f, 0.).sum(axis=2)
+    return np.where((n >= 2)[:, None], res, np.nan)
+
+
+def score_samples(x, bandwidths, y):
+    """
+    Log-density of Gaussian KDEs at points, for every row at once, as KernelDensity.score_samples
+
+    Inputs:
+        - x : Array (rows, samples) of the KDE samples, NaN-padded
+        - bandwidths : Array (rows,) of bandwidths
+        - y : Array (rows, points) of points to score, NaN where missing
+    Returns an array (rows, points) of log-densities, NaN at missing points
+    """
+    valid = ~np.isnan(x)
+    n = valid.sum(axis=1)
+    d2 = np.where(valid[:, None, :], (y[:, :, None] - x[:, None, :]) ** 2, np.inf)
+    nearest = d2.min(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        scale = -0.5 / bandwidths[:, None, None] ** 2
+        sums = np.exp(scale * (d2 - nearest)).sum(axis=2)
+        return scale[:, :, 0] * nearest[:, :, 0] + np.log(sums) - np.log(n * bandwidths * np.sqrt(2. * np.pi))[:, None]
+
+
+def _select(x, num, lo, hi):
+    # Best bandwidth and its score for each row of one chunk
+    grid = bandwidth_grid(x, num, lo, hi)
+    score = loo_loglik(x, grid)
+    best = np.argmax(np.where(np.isnan(score), -np.inf, score), axis=1)
+    rows = np.arange(len(x))
+    ok = ~np.isnan(score).all(axis=1)
+    return np.where(ok, grid[rows, best], np.nan), np.where(ok, score[rows, best], np.nan)
+
+
+def select_bandwidths(x, num=30, lo=0.5, hi=3., n_jobs=1):
+    """
+    Bandwidth maximising the leave-one-out log-likelihood of each row of 'x' over its
+    bandwidth_grid, the first one on ties as GridSearchCV
+
+    Rows are processed in chunks bounding the kernel array to BLOCK elements, spread over
+    'n_jobs' worker processes.
+
+    Returns (bandwidths, leave-one-out log-likelihoods) as arrays (rows,)
+    """
+    chunk = max(1, BLOCK // (num * max(x.shape[1], 1) ** 2))
+    chunks = [x[start:start + chunk] for start in range(0, len(x), chunk)]
+    args = (chunks, [num] * len(chunks), [lo] * len(chunks), [hi] * len(chunks))
+    if n_jobs == 1:
+        res = list(map(_select, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(_select, *args))
+    if not res:
+        return np.array([]), np.array([])
+    return tuple(np.concatenate(parts) for parts in zip(*res))
+
+
+def Bandwidths(ensembles, path=BANDWIDTHS, geoids=None, num=30, lo=0.5, hi=3., n_jobs=1):
+    """
+    Cross-validated KDE bandwidths of every county for several ensembles
+
+    Inputs:
+        - ensembles : Dict of ensemble name (e.g. 'nex', 'cmip') to its combined yield table
+        - path : CSV to write the table to, not written if None
+        - geoids : Counties to keep (e.g. those passing the regression filter), all if None
+        - num/lo/hi : Bandwidth grid, see bandwidth_grid
+        - n_jobs : Number of worker processes
+    Returns a Pandas DataFrame with GEOID and, for each ensemble, '<name>_bw' and the
+    leave-one-out log-likelihood '<name>_loo'
+    """
+    out = []
+    for name, data in ensembles.items():
+        index, x = ensemble_samples(data)
+        if geoids is not None:
+            keep = index.isin(fips(geoids))
+            index, x = index[keep], x[keep]
+        bw, loo = select_bandwidths(x, num, lo, hi, n_jobs)
+        out.append(pd.DataFrame({name + '_bw': bw, name + '_loo': loo}, index=index))
+    out = pd.concat(out, axis=1).rename_axis('GEOID').reset_index()
+    if path is not None:
+        out.to_csv(path, index=False)
+    return out
+
+
+def read_bandwidths(path=BANDWIDTHS):
+    """
+    Read a bandwidth table written by Bandwidths, indexed by 5 character GEOID
+    """
+    data = pd.read_csv(path, dtype={'GEOID': str})
+    return data.set_index(fips(data['GEOID']).rename('GEOID')).drop(columns='GEOID').astype(float)
+
+
+def read_bw_text(path, names=('nex', 'cmip')):
+    """
+    Read a line-per-value bandwidth file such as analysis/bw_final.txt (each GEOID followed
+    by one bandwidth per ensemble) into the layout of read_bandwidths
+    """
+    with open(path) as f:
+        lines = [line.strip() for line in f if line.strip()]
+    rows = np.array(lines).reshape(-1, len(names) + 1)
+    return pd.DataFrame(rows[:, 1:].astype(float), columns=[name + '_bw' for name in names],
+                        index=fips(rows[:, 0]).rename('GEOID'))
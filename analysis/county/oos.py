@@ -0,0 +1,131 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import analyse
+import engine
+import kde
+from countyindex import fips
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Inputs and output of OOS_Likelihood.ipynb
+REGRESSION = os.path.join(HERE, '../../data/GMFD_all/fitting/gmfd_regression_res_60-05.csv')
+NEX = os.path.join(HERE, '../combine/output/nex_yield_06-16.csv')
+CMIP = os.path.join(HERE, '../combine/output/cmip_yield_06-16.csv')
+OUTPUT = os.path.join(HERE, 'output/log_likelihoods_oos.csv')
+
+# Observations scored against the ensembles
+OBS = ['GMFD', 'USDA']
+
+# Counties scored per chunk
+CHUNK = 256
+
+
+def significant_counties(path=REGRESSION, alpha=0.05):
+    """
+    GEOIDs whose yield regression has a p-value below 'alpha' (the p05_counties of OOS_Likelihood.ipynb)
+    """
+    res = pd.read_csv(path, dtype={'GEOID': str})
+    return fips(res.loc[res['pval'] < alpha, 'GEOID'].unique())
+
+
+def read_yields(data, yearMin=2006, yearMax=2016):
+    """
+    Combined yield table (DataFrame, CSV path or store.Store) over a window of years,
+    with 5 character GEOIDs
+    """
+    if isinstance(data, str):
+        data = pd.read_csv(data, dtype={'GEOID': str})
+    data = analyse.as_frame(data, yearMin, yearMax)
+    if data.index.names != [None]:
+        data = data.reset_index()
+    data = data[(data['Year'] >= yearMin) & (data['Year'] <= yearMax)].copy()
+    data['GEOID'] = fips(data['GEOID'])
+    return data
+
+
+def _score(args):
+    # Log-likelihoods of the observations of one chunk of counties under each ensemble's KDE
+    samples, bandwidths, obs = args
+    return [kde.score_samples(x, bw, obs) for x, bw in zip(samples, bandwidths)]
+
+
+def OOSLikelihood(nex=NEX, cmip=CMIP, bandwidths=None, geoids=None, yearMin=2006, yearMax=2016,
+                  min_years=5, path=None, n_jobs=1):
+    """
+    Out-of-sample log-likelihoods of the GMFD and USDA yields under the NEX and CMIP
+    ensemble KDEs, for every county at once, as OOS_Likelihood.ipynb
+
+    The pooled members of each county form a Gaussian KDE, and all observations of all
+    counties are scored in vectorised chunks of counties, spread over 'n_jobs' worker processes.
+
+    Inputs:
+        - nex/cmip : Combined yield tables (DataFrame, CSV path or store.Store)
+        - bandwidths : DataFrame indexed by GEOID with 'nex_bw' and 'cmip_bw' (see
+                       kde.read_bandwidths), cross-validated with kde.Bandwidths if None
+        - geoids : Counties to score (e.g. significant_counties()), all if None
+        - yearMin/yearMax : Window of years
+        - min_years : Minimum number of NEX years of a county
+        - path : CSV to write the per-county table to (e.g. OUTPUT), not written if None
+        - n_jobs : Number of worker processes
+    Returns (per-county DataFrame in the layout of log_likelihoods_oos.csv, aggregate Series).
+    Per county, '<ensemble>_<obs>' holds the log-likelihoods of the sorted observations,
+    '_min' the one of the lowest observation and '_sum' their total; 'gmfd_min', 'gmfd_sum',
+    'usda_min' and 'usda_sum' are the NEX minus CMIP log-likelihood ratios. The aggregate
+    sums every '_min' and '_sum' column over the counties, with their number and the share
+    of counties whose GMFD ratios favour NEX.
+    """
+    data = {'nex': read_yields(nex, yearMin, yearMax), 'cmip': read_yields(cmip, yearMin, yearMax)}
+    # Counties with enough years, as the count filter of the notebook
+    counts = data['nex']['GEOID'].value_counts()
+    keep = counts.index[counts >= min_years]
+    if geoids is not None:
+        keep = keep.intersection(fips(geoids))
+    keep = keep.intersection(data['cmip']['GEOID'].unique())
+    if bandwidths is None:
+        bandwidths = kde.Bandwidths(data, path=None, geoids=keep, n_jobs=n_jobs).set_index('GEOID')
+    keep = keep.intersection(bandwidths.index).sort_values()
+
+    # Ensemble samples and observations aligned on the kept counties
+    samples = []
+    for name in ['nex', 'cmip']:
+        index, x = kde.ensemble_samples(data[name][data[name]['GEOID'].isin(keep)])
+        samples.append(x[index.get_indexer(keep)])
+    bws = [bandwidths.loc[keep, name + '_bw'].to_numpy(dtype=float) for name in ['nex', 'cmip']]
+    nex = data['nex'][data['nex']['GEOID'].isin(keep)].set_index('GEOID')
+    cube = engine.make_cube(nex, OBS)
+    obs = np.sort(np.where(cube.mask[:, :, None], cube.values, np.nan)[cube.index.get_indexer(keep)], axis=1)
+
+    # Score chunks of counties, all observations of a chunk at once
+    chunks = [(start, min(start + CHUNK, len(keep))) for start in range(0, len(keep), CHUNK)]
+    args = [([x[a:b] for x in samples], [bw[a:b] for bw in bws], obs[a:b].reshape(b - a, -1)) for a, b in chunks]
+    if n_jobs == 1:
+        res = list(map(_score, args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            res = list(executor.map(_score, args))
+    shape = (len(keep), obs.shape[1], len(OBS))
+    scores = [np.concatenate([r[e] for r in res]).reshape(shape) if res else np.empty(shape) for e in range(2)]
+
+    # Per-county table
+    n_obs = (~np.isnan(obs)).sum(axis=1)
+    out = pd.DataFrame({'GEOID': keep})
+    for name, score in zip(['nex', 'cmip'], scores):
+        for o, label in enumerate(OBS):
+            out[name + '_' + label.lower()] = [s[:k] for s, k in zip(score[:, :, o], n_obs[:, o])]
+        for o, label in enumerate(OBS):
+            out[name + '_' + label.lower() + '_min'] = score[:, 0, o]
+            out[name + '_' + label.lower() + '_sum'] = score[:, :, o].sum(axis=1, where=~np.isnan(obs[:, :, o]))
+    for label in ['gmfd', 'usda']:
+        for stat in ['min', 'sum']:
+            out[label + '_' + stat] = out['nex_' + label + '_' + stat] - out['cmip_' + label + '_' + stat]
+    if path is not None:
+        out.to_csv(path, index=False)
+
+    # Aggregates over all counties
+    totals = out[[col for col in out.columns if col.endswith('_min') or col.endswith('_sum')]].sum()
+    totals['counties'] = len(out)
+    totals['nex_favoured_gmfd_min'] = (out['gmfd_min'] > 0.).mean()
+    totals['nex_favoured_gmfd_sum'] = (out['gmfd_sum'] > 0.).mean()
+    return out, totals
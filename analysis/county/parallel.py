@@ -0,0 +1,97 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import engine
+
+
+def shard_bounds(index, n_shards, shard='geoid'):
+    """
+    Split the sorted groups of a cube into contiguous shards, returned as (start, stop) pairs
+
+    Inputs:
+        - index : Index/MultiIndex of the cube groups (with a 'GEOID' level)
+        - n_shards : Number of shards to aim for
+        - shard : 'geoid' to split anywhere, 'state' to keep each state FIPS prefix in one shard
+    """
+    n = len(index)
+    bounds = np.linspace(0, n, n_shards + 1).astype(int)
+    if shard == 'state':
+        # Only allow cuts where the (AgVar,) state prefix changes
+        keys = pd.Series(index.get_level_values('GEOID')).str[:2]
+        if isinstance(index, pd.MultiIndex):
+            keys = pd.Series(index.get_level_values(0)) + keys
+        cuts = np.flatnonzero(keys.to_numpy()[1:] != keys.to_numpy()[:-1]) + 1
+        cuts = np.concatenate([[0], cuts, [n]])
+        bounds = cuts[np.searchsorted(cuts, bounds)]
+    elif shard != 'geoid':
+        raise ValueError("shard must be 'geoid' or 'state'")
+    bounds = np.unique(bounds).tolist()
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _to_shared(arr):
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+    return shm
+
+
+def _attach(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _work(spec):
+    # Compute one shard straight from shared memory and write it into the shared output
+    (values, mask, out), (start, stop), columns, metric, models, truth = spec
+    blocks = [_attach(*values), _attach(*mask), _attach(*out)]
+    try:
+        cube = engine.Cube(blocks[0][1][start:stop], blocks[1][1][start:stop], None, columns)
+        blocks[2][1][start:stop] = engine.compute(cube, metric, models, truth)
+    finally:
+        for shm, _ in blocks:
+            shm.close()
+
+
+def compute(cube, metric, models, truth=None, n_jobs=1, shard='geoid'):
+    """
+    Parallel version of engine.compute, sharding the cube's groups across worker processes
+
+    The cube is placed once in shared memory, so workers never receive a pickled copy
+    of the data. Each group is reduced exactly as in the serial path, and shards write
+    to fixed rows of the output, so the result is identical to engine.compute.
+
+    Inputs:
+        - cube : Cube built with engine.make_cube
+        - metric : Metric passed to engine.compute
+        - models : Columns of the cube to verify
+        - truth : Column of the cube to verify against
+        - n_jobs : Number of worker processes, 1 runs serially
+        - shard : 'geoid' or 'state', see shard_bounds
+    """
+    if n_jobs == 1 or len(cube.index) == 0:
+        return engine.compute(cube, metric, models, truth)
+    shms = [_to_shared(cube.values), _to_shared(cube.mask)]
+    out_shape = (len(cube.index), len(models))
+    shms.append(shared_memory.SharedMemory(create=True, size=max(8 * out_shape[0] * out_shape[1], 1)))
+    try:
+        refs = ((shms[0].name, cube.values.shape, cube.values.dtype),
+                (shms[1].name, cube.mask.shape, cube.mask.dtype),
+                (shms[2].name, out_shape, np.float64))
+        specs = [(refs, bounds, cube.columns, metric, list(models), truth)
+                 for bounds in shard_bounds(cube.index, 4 * n_jobs, shard)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            list(executor.map(_work, specs))
+        return np.ndarray(out_shape, dtype=np.float64, buffer=shms[2].buf).copy()
+    finally:
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+
+def Verify(cube, metric, models, truth, n_jobs=1, shard='geoid'):
+    """
+    Parallel version of engine.Verify, see compute
+    """
+    res = compute(cube, metric, models, truth, n_jobs, shard)
+    return pd.DataFrame(res, index=cube.index, columns=pd.Index(models))
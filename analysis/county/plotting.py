@@ -1,24 +1,112 @@
+import hashlib
+import os
+import tempfile
+import warnings
 import numpy as np
 import pandas as pd
-import geopandas as gp
 import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap, ListedColormap
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from countyindex import CountyIndex, load_counties
 
-# Import Scientific Colormaps
-cm_data = np.loadtxt("/Users/davidlafferty/Projects/misc/ScientificColourMaps5/cork/cork.txt")[::-1]
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Import Scientific Colormaps (shipped in ./colormaps)
+cm_data = np.loadtxt(os.path.join(HERE, "colormaps/cork.txt"))[::-1]
 cork_map = LinearSegmentedColormap.from_list("Cork", cm_data)
-cm_data = np.loadtxt("/Users/davidlafferty/Projects/misc/ScientificColourMaps5/batlow/batlow.txt")
+cm_data = np.loadtxt(os.path.join(HERE, "colormaps/batlow.txt"))
 batlow_map = LinearSegmentedColormap.from_list("Batlow", cm_data)
-cm_data = np.loadtxt("/Users/davidlafferty/Projects/misc/ScientificColourMaps5/berlin/berlin.txt")
+cm_data = np.loadtxt(os.path.join(HERE, "colormaps/berlin.txt"))
 berlin_map = LinearSegmentedColormap.from_list("Berlin", cm_data)
 
-# Import plotting shapefiles
-county_shp = gp.read_file('../../data/conus_shp/conus_plot/final/counties_contig_plot.shp')
-county_shp["GEOID"] = county_shp["GEOID"].astype(str).str.zfill(5)
+# Plotting shapefiles (EPSG:2163), loaded on first use and cached as GeoParquet
+PLOT_SHP = os.path.join(HERE, '../../data/conus_shp/conus_plot/final/{}_contig_plot.shp')
+CACHE_DIR = os.path.join(HERE, 'cache')
+# Simplification tolerance in metres, well below a pixel of a full-page CONUS map
+SIMPLIFY = 1000.
+# Default pixel size (m) of the raster maps
+RASTER_RES = 2500.
+
+_geometry = {}
+
+
+def geometry(name):
+    """
+    Return the 'counties', 'states' or 'coast' plotting GeoDataFrame, loading it on first use
+
+    The simplified geometry is cached in CACHE_DIR as GeoParquet per SIMPLIFY and rebuilt
+    whenever the shapefile is newer than the cache. Without pyarrow it is not cached, with a
+    warning, and every process reads and simplifies the shapefile again.
+    """
+    if name not in _geometry:
+        import geopandas as gp
+        shp = PLOT_SHP.format(name)
+        cache = os.path.join(CACHE_DIR, '{}_{:g}.parquet'.format(name, SIMPLIFY))
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(shp):
+            shapes = gp.read_parquet(cache)
+        else:
+            shapes = gp.read_file(shp)
+            if name == 'counties':
+                shapes["GEOID"] = shapes["GEOID"].astype(str).str.zfill(5)
+            shapes["geometry"] = shapes.geometry.simplify(SIMPLIFY)
+            try:
+                _write_atomic(cache, shapes.to_parquet)
+            except ImportError:
+                if not _geometry.get('warned'):
+                    _geometry['warned'] = True
+                    warnings.warn('pyarrow is not installed, so the plotting geometry is not cached and '
+                                  'the shapefiles are read again in every process')
+        _geometry[name] = shapes
+    return _geometry[name]
+
+
+def boundary(name):
+    """
+    Return the boundary lines of the 'states' or 'coast' plotting geometry, computed once
+    """
+    key = name + '_boundary'
+    if key not in _geometry:
+        _geometry[key] = geometry(name).geometry.boundary
+    return _geometry[key]
+
+
+def plot_counties():
+    """
+    Return the CountyIndex of the plotted counties, built from the cached plotting geometry
+    so plots never read the full county shapefile
+    """
+    if 'index' not in _geometry:
+        _geometry['index'] = CountyIndex(geometry('counties')["GEOID"])
+    return _geometry['index']
+
+
+def county_positions():
+    """
+    Return the position of each plotted county in plot_counties
+    """
+    if 'positions' not in _geometry:
+        _geometry['positions'] = plot_counties().positions(geometry('counties')["GEOID"])
+    return _geometry['positions']
+
+
+def __getattr__(name):
+    # Old module-level names, now loaded lazily
+    if name in ['county_shp', 'states', 'coast']:
+        return geometry({'county_shp': 'counties'}.get(name, name))
+    if name == 'counties':
+        return load_counties()
+    if name == 'county_pos':
+        return county_positions()
+    raise AttributeError(name)
 
-states = gp.read_file('../../data/conus_shp/conus_plot/final/states_contig_plot.shp')
-coast = gp.read_file('../../data/conus_shp/conus_plot/final/coast_contig_plot.shp')
+
+def attach(data, model):
+    """
+    Attach one model column of a GEOID-indexed DataFrame to the county shapes by position
+    """
+    pos = county_positions()
+    values = plot_counties().align(data[model])
+    return geometry('counties').assign(**{model: np.where(pos >= 0, values[pos], np.nan)})
 
 
 def PlotAgVar(data, model, agvar, title, vmin, vmax, cmap, save=False):
@@ -37,18 +125,17 @@ def PlotAgVar(data, model, agvar, title, vmin, vmax, cmap, save=False):
     # Select Ag variable
     data = data.reset_index()
     data = data[data.AgVar == agvar]
-    # Merge county-level shapefile with data
-    data['GEOID'] = data["GEOID"].astype(str).str.zfill(5)
+    # Attach data to the county-level shapefile by position
     data.set_index(['GEOID'], inplace=True)
-    data_shp = pd.merge(county_shp, data.filter([model]), on="GEOID", how="outer", copy=False)
+    data_shp = attach(data, model)
     # Do the plot!
     fig, ax = plt.subplots(1, 1, figsize=(18, 10))
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.1)
     cax.tick_params(labelsize=20)
     data_shp.dropna().plot(column=model, ax=ax, cax=cax, legend=True, cmap=globals()[cmap + '_map'], vmin=vmin, vmax=vmax)
-    states.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
-    coast.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('states').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('coast').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
     ax.tick_params(labelbottom=False, labelleft=False)
     ax.set_title(title, fontsize=20)
     plt.tight_layout()
@@ -67,11 +154,10 @@ def PlotYield(data, model, title, vmin, vmax, cmap, save=False):
         - cmap: Colormap to use in plot ('batlow' or 'broc')
         - save: Boolean, savefig or not
     """
-    # Merge county-level shapefile with data
+    # Attach data to the county-level shapefile by position
     data = data.reset_index()
-    data['GEOID'] = data["GEOID"].astype(str).str.zfill(5)
     data.set_index(['GEOID'], inplace=True)
-    data_shp = pd.merge(county_shp, data.filter([model]), on="GEOID", how="outer", copy=False)
+    data_shp = attach(data, model)
     # Do the plot!
     fig, ax = plt.subplots(1, 1, figsize=(18, 10))
     divider = make_axes_locatable(ax)
@@ -79,8 +165,8 @@ def PlotYield(data, model, title, vmin, vmax, cmap, save=False):
     cax.tick_params(labelsize=20)
     data_shp.dropna().plot(column=model, ax=ax, cax=cax, legend=True, cmap=globals()[cmap + '_map'], vmin=vmin, vmax=vmax)
     data_shp[data_shp[model].isna()].plot(ax=ax, color="lightgray")
-    states.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
-    coast.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('states').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('coast').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
     ax.tick_params(labelbottom=False, labelleft=False)
     ax.set_title(title, fontsize=20)
     plt.tight_layout()
@@ -105,21 +191,343 @@ def PlotRatio(data, model, vmin, vmax, cmap, title, agvar=False, save=False):
     else:
         data = data.reset_index()
         data = data[data.AgVar == agvar]
-    # Merge county-level shapefile with data
-    data['GEOID'] = data["GEOID"].astype(str).str.zfill(5)
+    # Attach data to the county-level shapefile by position
     data.set_index(['GEOID'], inplace=True)
-    data_shp = pd.merge(county_shp, data.filter([model]), on="GEOID", how="outer", copy=False)
+    data_shp = attach(data, model)
     # Do the plot!
     fig, ax = plt.subplots(1, 1, figsize=(18, 10))
     divider = make_axes_locatable(ax)
     cax = divider.append_axes("right", size="5%", pad=0.1)
     cax.tick_params(labelsize=20)
     data_shp.dropna().plot(column=model, ax=ax, cax=cax, legend=True, cmap=globals()[cmap + '_map'], vmin=vmin, vmax=vmax)
-    states.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
-    coast.geometry.boundary.plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('states').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
+    boundary('coast').plot(ax=ax, linewidth=0.5, edgecolor="black", color=None)
     if agvar == False:
         data_shp[data_shp[model].isna()].plot(ax=ax, color="lightgray")
     ax.tick_params(labelbottom=False, labelleft=False)
     ax.set_title(title, fontsize=20)
     plt.tight_layout()
     plt.show()
+
+
+def _rings(geom):
+    # Exterior and interior rings of a (Multi)Polygon
+    for poly in getattr(geom, 'geoms', [geom]):
+        yield poly.exterior
+        for ring in poly.interiors:
+            yield ring
+
+
+def _lines(geom):
+    # Parts of a (Multi)LineString
+    for line in getattr(geom, 'geoms', [geom]):
+        yield np.asarray(line.coords)[:, :2]
+
+
+def county_paths():
+    """
+    Return one matplotlib Path per plotted county (holes included), built once
+    """
+    if 'paths' not in _geometry:
+        from matplotlib.path import Path
+        paths = []
+        for geom in geometry('counties').geometry:
+            rings = [] if geom is None or geom.is_empty else list(_rings(geom))
+            paths.append(Path.make_compound_path(*[Path(np.asarray(ring.coords)[:, :2], closed=True)
+                                                   for ring in rings]) if rings else Path(np.zeros((0, 2))))
+        _geometry['paths'] = paths
+    return _geometry['paths']
+
+
+def boundary_segments(name):
+    """
+    Return the boundary lines of the 'states' or 'coast' geometry as a list of (n, 2) arrays, built once
+    """
+    key = name + '_segments'
+    if key not in _geometry:
+        _geometry[key] = [seg for geom in boundary(name) if geom is not None for seg in _lines(geom)]
+    return _geometry[key]
+
+
+def _fingerprint(name):
+    # SHA-256 of the parts of a plotting shapefile, computed once
+    key = name + '_fingerprint'
+    if key not in _geometry:
+        digest = hashlib.sha256()
+        root = os.path.splitext(PLOT_SHP.format(name))[0]
+        for part in ['.shp', '.shx', '.dbf', '.prj']:
+            if os.path.exists(root + part):
+                with open(root + part, 'rb') as f:
+                    for block in iter(lambda: f.read(1 << 20), b''):
+                        digest.update(block)
+        _geometry[key] = digest.hexdigest()
+    return _geometry[key]
+
+
+def _burn(name, res):
+    # Rasterize the plotting geometry on a grid covering the counties, cached per resolution
+    # under a key of the shapefiles (the geometry and the county extent) and SIMPLIFY
+    digest = hashlib.sha256('{}|{!r}|{!r}'.format(name, SIMPLIFY, float(res)).encode())
+    for source in sorted({name, 'counties'}):
+        digest.update(_fingerprint(source).encode())
+    cache = os.path.join(CACHE_DIR, '{}_raster_{:g}_{}.npz'.format(name, res, digest.hexdigest()[:16]))
+    if os.path.exists(cache):
+        with np.load(cache) as f:
+            return f['raster'], tuple(f['extent'])
+    from rasterio.features import rasterize
+    from rasterio.transform import from_origin
+    minx, miny, maxx, maxy = geometry('counties').total_bounds
+    shape = (int(np.ceil((maxy - miny) / res)), int(np.ceil((maxx - minx) / res)))
+    transform = from_origin(minx, maxy, res, res)
+    if name == 'counties':
+        # County row of each pixel, -1 outside all counties
+        shapes = zip(geometry('counties').geometry, range(len(geometry('counties'))))
+        raster = rasterize(shapes, out_shape=shape, transform=transform, fill=-1, dtype='int32')
+    else:
+        lines = [geom for geom in boundary(name) if geom is not None and not geom.is_empty]
+        raster = rasterize(lines, out_shape=shape, transform=transform, fill=0, default_value=1,
+                           all_touched=True, dtype='uint8')
+    extent = (minx, minx + shape[1] * res, maxy - shape[0] * res, maxy)
+    _write_atomic(cache, lambda tmp: np.savez_compressed(tmp, raster=raster, extent=extent))
+    return raster, extent
+
+
+def _write_atomic(path, write):
+    # Write a cache file through write(tmp) to a unique temporary file next to it and move it
+    # into place, so concurrent workers never read or overwrite each other's partial files
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def county_raster(res=RASTER_RES):
+    """
+    Return (raster, extent) of the plotted county row of each pixel (-1 outside), burned once
+
+    The raster is cached in CACHE_DIR per resolution 'res' (m) and rebuilt whenever the
+    county shapefile or SIMPLIFY changes. 'extent' is in the imshow (left, right, bottom, top) order.
+    """
+    key = ('county_raster', res)
+    if key not in _geometry:
+        _geometry[key] = _burn('counties', res)
+    return _geometry[key]
+
+
+def boundary_overlay(res=RASTER_RES):
+    """
+    Return the RGBA image of the state and coast boundaries on the county raster grid, burned once
+    """
+    key = ('boundary_overlay', res)
+    if key not in _geometry:
+        lines = np.maximum(_burn('states', res)[0], _burn('coast', res)[0])
+        overlay = np.zeros(lines.shape + (4,), dtype=np.float32)
+        overlay[..., 3] = lines
+        _geometry[key] = overlay
+    return _geometry[key]
+
+
+def raster_values(values, res=RASTER_RES):
+    """
+    Return the masked image of one value per plotted county (see county_values) on the county raster
+    """
+    raster, _ = county_raster(res)
+    return np.ma.masked_invalid(np.append(np.asarray(values, dtype=float), np.nan)[raster])
+
+
+def county_values(data, models, agvar=None):
+    """
+    Return a (plotted counties, models) array of metric values aligned by county position
+
+    Inputs:
+        - data: Pandas DataFrame of pre-calculated verification metric for all models
+        - models: List of model names
+        - agvar: Agricultural variable to select from an (AgVar, GEOID) index
+    """
+    if agvar:
+        data = data.xs(agvar, level='AgVar')
+    pos = county_positions()
+    values = plot_counties().align(data.filter(models))
+    return np.where(pos[:, None] >= 0, values[pos], np.nan)
+
+
+def MapPanel(ax, values, vmin, vmax, cmap, missing=None, res=None):
+    """
+    Draw one county map on an axis from the cached county paths and boundary lines
+
+    Inputs:
+        - ax: Matplotlib axis
+        - values: Array of one value per plotted county (see county_values)
+        - vmin/vmax : Min/Max values to be plotted
+        - cmap: Colormap to use in plot ('batlow', 'cork' or 'berlin')
+        - missing: Colour for counties without data, not drawn if None
+        - res: Pixel size (m) to draw a raster map at instead (see county_raster)
+    Returns the county artist, whose values can be updated with set_values
+    """
+    from matplotlib.collections import PathCollection, LineCollection
+    cmap = globals()[cmap + '_map'].copy()
+    if res:
+        raster, extent = county_raster(res)
+        cmap.set_bad('none')
+        if missing is not None:
+            # Backdrop of the missing colour under the county pixels only
+            ax.imshow(np.ma.masked_less(raster, 0), cmap=ListedColormap([missing]), extent=extent,
+                      interpolation='nearest')
+        counties = ax.imshow(raster_values(values, res), cmap=cmap, vmin=vmin, vmax=vmax,
+                             extent=extent, interpolation='nearest')
+        ax.imshow(boundary_overlay(res), extent=extent, interpolation='nearest')
+    else:
+        cmap.set_bad(missing if missing is not None else 'none')
+        counties = PathCollection(county_paths(), cmap=cmap, edgecolors='none', linewidths=0)
+        counties.set_array(np.ma.masked_invalid(values))
+        counties.set_clim(vmin, vmax)
+        ax.add_collection(counties)
+        for name in ['states', 'coast']:
+            ax.add_collection(LineCollection(boundary_segments(name), linewidths=0.5, colors='black'))
+        ax.autoscale_view()
+    ax.set_aspect('equal')
+    ax.tick_params(labelbottom=False, labelleft=False)
+    return counties
+
+
+def set_values(counties, values, res=None):
+    """
+    Update the county values of an artist returned by MapPanel (drawn at the same 'res')
+    """
+    if res:
+        counties.set_data(raster_values(values, res))
+    else:
+        counties.set_array(np.ma.masked_invalid(values))
+
+
+def PlotGrid(data, models, vmin, vmax, cmap, agvar=None, ncols=3, figsize=(8, 11), missing=None, res=None,
+             save=None):
+    """
+    Plots small multiples of the county-level maps of one metric, one panel per model
+
+    Inputs:
+        - data: Pandas DataFrame of pre-calculated verification metric for all models
+        - models: List of model names, one panel each
+        - vmin/vmax : Min/Max values to be plotted
+        - cmap: Colormap to use in plot ('batlow', 'cork' or 'berlin')
+        - agvar: Agricultural variable to be plotted ('gdd', 'egdd', 'prcp')
+        - ncols: Number of panel columns
+        - missing: Colour for counties without data, not drawn if None
+        - res: Pixel size (m) to draw raster maps at, vector maps if None
+        - save: File name to save the figure to, shown if None
+    """
+    values = county_values(data, models, agvar)
+    nrows = int(np.ceil(len(models) / ncols))
+    fig, axes = plt.subplots(nrows, ncols, figsize=figsize, squeeze=False)
+    for i, (name, ax) in enumerate(zip(models, axes.flatten())):
+        divider = make_axes_locatable(ax)
+        cax = divider.append_axes("right", size="5%", pad=0.1)
+        fig.colorbar(MapPanel(ax, values[:, i], vmin, vmax, cmap, missing, res), cax=cax)
+        ax.set_title(name)
+    for ax in axes.flatten()[len(models):]:
+        ax.axis('off')
+    plt.tight_layout()
+    if save:
+        plt.savefig(save, dpi=500)
+        plt.close(fig)
+    else:
+        plt.show()
+
+
+def _render_files(values, models, vmin, vmax, cmap, path, titles, missing, dpi, res):
+    # Draw the map once, then only swap the county values for each file
+    fig, ax = plt.subplots(1, 1, figsize=(18, 10))
+    divider = make_axes_locatable(ax)
+    cax = divider.append_axes("right", size="5%", pad=0.1)
+    cax.tick_params(labelsize=20)
+    collection = MapPanel(ax, values[:, 0], vmin, vmax, cmap, missing, res)
+    fig.colorbar(collection, cax=cax)
+    plt.tight_layout()
+    files = []
+    for i, model in enumerate(models):
+        set_values(collection, values[:, i], res)
+        ax.set_title(titles[i], fontsize=20)
+        files.append(path.format(model=model))
+        fig.savefig(files[-1], dpi=dpi)
+    plt.close(fig)
+    return files
+
+
+def PlotFiles(data, models, vmin, vmax, cmap, path, agvar=None, titles=None, missing=None, dpi=100, res=None,
+              n_jobs=1):
+    """
+    Writes one county-level map file per model, reusing the same figure and geometry
+
+    Inputs:
+        - data: Pandas DataFrame of pre-calculated verification metric for all models
+        - models: List of model names
+        - vmin/vmax : Min/Max values to be plotted
+        - cmap: Colormap to use in plot ('batlow', 'cork' or 'berlin')
+        - path: File name pattern with a '{model}' field, e.g. 'figs/r2_{model}.png'
+        - agvar: Agricultural variable to be plotted ('gdd', 'egdd', 'prcp')
+        - titles: List of plot titles, defaults to the model names
+        - missing: Colour for counties without data, not drawn if None
+        - dpi: Resolution of the files
+        - res: Pixel size (m) to draw raster maps at, vector maps if None
+        - n_jobs: Number of worker processes to render files in
+    Returns the list of files written
+    """
+    models = list(models)
+    titles = models if titles is None else list(titles)
+    values = county_values(data, models, agvar)
+    if n_jobs == 1:
+        return _render_files(values, models, vmin, vmax, cmap, path, titles, missing, dpi, res)
+    from concurrent.futures import ProcessPoolExecutor
+    # Build the geometry caches once here rather than in every worker
+    if res is None:
+        for name in ['states', 'coast']:
+            geometry(name)
+    else:
+        county_raster(res)
+        boundary_overlay(res)
+    chunks = [chunk for chunk in np.array_split(np.arange(len(models)), n_jobs) if len(chunk) > 0]
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        jobs = [executor.submit(_render_files, values[:, chunk], [models[i] for i in chunk], vmin, vmax,
+                                cmap, path, [titles[i] for i in chunk], missing, dpi, res) for chunk in chunks]
+        return [f for job in jobs for f in job.result()]
+
+
+class QuickLook:
+    """
+    Interactive raster map for flipping through many metric/model maps
+
+    The county raster, boundary overlay and figure are built once, each call to show
+    only swaps the image data.
+
+    Inputs:
+        - data: Pandas DataFrame of pre-calculated verification metric for all models
+        - vmin/vmax : Min/Max values to be plotted
+        - cmap: Colormap to use in plot ('batlow', 'cork' or 'berlin')
+        - agvar: Agricultural variable to be plotted ('gdd', 'egdd', 'prcp')
+        - missing: Colour for counties without data, not drawn if None
+        - res: Pixel size (m) of the raster map
+    """
+
+    def __init__(self, data, vmin, vmax, cmap, agvar=None, missing='lightgray', res=RASTER_RES):
+        self.models = list(data.columns)
+        self.values = county_values(data, self.models, agvar)
+        self.res = res
+        self.fig, self.ax = plt.subplots(1, 1, figsize=(12, 7))
+        cax = make_axes_locatable(self.ax).append_axes("right", size="5%", pad=0.1)
+        self.image = MapPanel(self.ax, self.values[:, 0], vmin, vmax, cmap, missing, res)
+        self.fig.colorbar(self.image, cax=cax)
+
+    def show(self, model, title=None):
+        """
+        Show the map of one model column
+        """
+        set_values(self.image, self.values[:, self.models.index(model)], self.res)
+        self.ax.set_title(model if title is None else title)
+        self.fig.canvas.draw_idle()
+        return self.fig
@@ -0,0 +1,135 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from countyindex import fips
+
+# Key columns of the combined ensemble tables, in on-disk dimension order
+KEYS = ['AgVar', 'GEOID', 'Year']
+
+
+def WriteStore(data, path, dtype=np.float64):
+    """
+    Write a combined ensemble table to an on-disk cube store
+
+    The store is a directory holding 'values.npy', a dense array with dimensions
+    (AgVar, GEOID, Year, model) - or (GEOID, Year, model) for yields - and
+    'coords.json' with the labels of each dimension.
+
+    Inputs:
+        - data : Pandas DataFrame (or path to CSV) as written by combine_all, with
+                 'AgVar' (optional), 'GEOID' and 'Year' columns and one column per model
+        - path : Directory to write the store to
+        - dtype : Floating point type of the stored values
+    """
+    if isinstance(data, str):
+        data = pd.read_csv(data, dtype={'GEOID': str})
+    if data.index.names != [None]:
+        data = data.reset_index()
+    data = data.drop(columns=[col for col in data.columns if col not in KEYS and not
+                              pd.api.types.is_numeric_dtype(data[col])])
+    data["GEOID"] = data["GEOID"].astype(str).str.zfill(5)
+    keys = [key for key in KEYS if key in data.columns]
+    models = [col for col in data.columns if col not in keys]
+    # Dimension codes and labels
+    codes, coords = [], {}
+    for key in keys:
+        code, labels = pd.factorize(data[key], sort=True)
+        codes.append(code)
+        coords[key] = labels.tolist()
+    coords['model'] = models
+    # Fill the dense array
+    values = write_cube(path, coords, dtype)
+    values[...] = np.nan
+    values[tuple(codes)] = data[models].to_numpy(dtype=dtype)
+    values.flush()
+
+
+def write_cube(path, coords, dtype=np.float64):
+    """
+    Create the files of a store with the given coordinates
+
+    Inputs:
+        - path : Directory to write the store to
+        - coords : Dict of the labels of each dimension, in order and ending with 'model'
+        - dtype : Floating point type of the stored values
+    Returns the writable memory map of 'values.npy', to be filled by the caller
+    """
+    shape = tuple(len(coords[dim]) for dim in coords)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'coords.json'), 'w') as f:
+        json.dump({'dims': list(coords), 'coords': coords}, f)
+    return np.lib.format.open_memmap(os.path.join(path, 'values.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+class Store:
+    """
+    Memory-mapped cube store written by WriteStore
+
+    Only the pages covering the requested AgVars, counties, years and models are read.
+
+    Attributes:
+        - dims : Names of the dimensions, ending with 'model'
+        - coords : Dict of the labels of each dimension
+        - values : Read-only memory map of the dense array
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'coords.json')) as f:
+            meta = json.load(f)
+        self.dims = meta['dims']
+        self.coords = meta['coords']
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+
+    def select(self, agvars=None, geoids=None, years=None, models=None):
+        """
+        Return (array, coords) of a sub-cube
+
+        Inputs:
+            - agvars : List of AgVars, defaults to all
+            - geoids : List of GEOIDs (strings or integers), defaults to all
+            - years : List of years or a (yearMin, yearMax) tuple, defaults to all
+            - models : List of model columns, defaults to all
+        Raises KeyError if any requested label is not in the store
+        """
+        request = {'AgVar': agvars, 'GEOID': geoids, 'Year': years, 'model': models}
+        idx, coords = [], {}
+        for dim in self.dims:
+            labels = pd.Index(self.coords[dim])
+            want = request[dim]
+            if want is None:
+                pos = np.arange(len(labels))
+            elif dim == 'Year' and isinstance(want, tuple):
+                pos = np.flatnonzero((labels >= want[0]) & (labels <= want[1]))
+            else:
+                want = fips(want) if dim == 'GEOID' else pd.Index(want).astype(labels.dtype)
+                pos = labels.get_indexer(want)
+                if (pos < 0).any():
+                    raise KeyError('Not in the store %s: %s' % (dim, list(want[pos < 0])))
+            idx.append(pos)
+            coords[dim] = labels[pos]
+        # Read contiguous ranges as slices, the rest by fancy indexing
+        values = self.values
+        for axis, pos in enumerate(idx):
+            if len(pos) == values.shape[axis]:
+                continue
+            if len(pos) > 0 and np.array_equal(pos, np.arange(pos[0], pos[-1] + 1)):
+                values = values[(slice(None),) * axis + (slice(pos[0], pos[-1] + 1),)]
+            else:
+                values = np.take(values, pos, axis=axis)
+        return np.asarray(values), coords
+
+    def frame(self, agvars=None, geoids=None, years=None, models=None):
+        """
+        Return a sub-cube in the long DataFrame layout of the combine CSVs
+
+        Rows with no values at all (absent in the original table) are dropped.
+        Inputs as in select.
+        """
+        values, coords = self.select(agvars, geoids, years, models)
+        keys = self.dims[:-1]
+        values = values.reshape(-1, values.shape[-1])
+        present = ~np.isnan(values).all(axis=1)
+        index = pd.MultiIndex.from_product([coords[key] for key in keys], names=keys)
+        data = pd.DataFrame(values[present], columns=coords['model'], index=index[present])
+        return data.reset_index()
@@ -0,0 +1,171 @@
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, '../county'))
+from countyindex import CountyIndex, fips
+
+# County to national production weights of weights/production_weights.ipynb
+WEIGHTS = os.path.join(HERE, 'weights/usda_county_to_national_weights.csv')
+
+
+class ProductionWeights:
+    """
+    County shares of production (yield x harvested area) as a dense year x county matrix
+
+    Attributes:
+        - counties : CountyIndex of the weighted counties (columns)
+        - years : Index of the years with production data (rows)
+        - production : Array (years, counties) of production, 0 where a county has none
+    """
+
+    def __init__(self, counties, years, production):
+        self.counties = counties
+        self.years = pd.Index(years, name='Year')
+        self.production = production
+
+    @classmethod
+    def from_usda(cls, usda):
+        """
+        Build the weights from USDA county yields with state_fips_code and county_code (or a
+        5 character 'GEOID'), 'year', 'Value' and 'area' columns, e.g. the weights CSV or
+        USDA_county_yields_w_county_trends.csv. Rows of the same county and year are summed.
+        """
+        if 'state_fips_code' in usda.columns:
+            geoid = fips(usda['state_fips_code'].astype(str).str.zfill(2) + usda['county_code'].astype(str).str.zfill(3))
+        else:
+            geoid = fips(usda['GEOID'])
+        counties = CountyIndex(geoid)
+        years, rows = np.unique(usda['year'].to_numpy(), return_inverse=True)
+        production = np.zeros((len(years), len(counties)))
+        np.add.at(production, (rows, counties.positions(geoid)),
+                  (usda['Value'] * usda['area']).to_numpy(dtype=float))
+        return cls(counties, years, production)
+
+    @classmethod
+    def load(cls, path=WEIGHTS):
+        """
+        Weights of a weights CSV, cached next to it as '<name>_matrix.npz'
+
+        The cache is rebuilt when the CSV is newer than it.
+        """
+        cache = os.path.splitext(path)[0] + '_matrix.npz'
+        if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+            with np.load(cache, allow_pickle=False) as f:
+                return cls(CountyIndex(f['geoids']), f['years'], f['production'])
+        weights = cls.from_usda(pd.read_csv(path, dtype={'GEOID': str}))
+        # Unique temporary file, as concurrent jobs may build the cache at once
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, geoids=np.asarray(weights.counties.geoids, dtype=str), years=weights.years.to_numpy(),
+                         production=weights.production)
+            os.replace(tmp, cache)
+        except BaseException:
+            os.remove(tmp)
+            raise
+        return weights
+
+    def matrix(self, years, static=False):
+        """
+        Production of the counties in each of 'years', as a (years, counties) array
+
+        Years without production data (e.g. projections) get the mean production over all
+        years with data, as do all years if 'static'.
+        """
+        years = pd.Index(years)
+        mean = self.production.mean(axis=0)
+        if static:
+            return np.tile(mean, (len(years), 1))
+        pos = self.years.get_indexer(years)
+        return np.where((pos >= 0)[:, None], self.production[np.maximum(pos, 0)], mean)
+
+    def groups(self, level):
+        """
+        Group of each county at a 'national' (one group) or 'state' level
+
+        Returns (int array of group codes, Index of the group labels)
+        """
+        if level == 'national':
+            return np.zeros(len(self.counties), dtype=np.int64), pd.Index(['US'], name='Region')
+        if level == 'state':
+            codes, states = pd.factorize(self.counties.geoids.str[:2], sort=True)
+            return codes, pd.Index(states, name='State')
+        raise ValueError("level must be 'national' or 'state'")
+
+
+_WEIGHTS = {}
+
+
+def load_weights(path=WEIGHTS):
+    """
+    Return the ProductionWeights of a weights CSV, loading each file once per session
+    unless it changed
+    """
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key not in _WEIGHTS:
+        _WEIGHTS[key] = ProductionWeights.load(path)
+    return _WEIGHTS[key]
+
+
+def Aggregate(data, weights=None, level='national', models=None, static=False):
+    """
+    Production-weighted national or state series of every model column at once
+
+    All AgVars, years and models go through two sparse-dense matrix products of a (region x
+    year, row) production matrix with the data, one for the weighted sums and one for the
+    weights of the counties with values. Each (region, year, model) is the mean over the
+    counties that have a value, their weights renormalised, so counties missing from a year
+    (or model) neither count as zero nor bias the weights.
+
+    Inputs:
+        - data : Pandas DataFrame in the layout of the combine outputs, with 'GEOID', 'Year'
+                 and optionally 'AgVar' columns (or index levels) and one column per model
+        - weights : ProductionWeights, those of weights/usda_county_to_national_weights.csv if None
+        - level : 'national' or 'state'
+        - models : Model columns to aggregate (e.g. NEX/CMIP members, GMFD, USDA, ensemble_mean),
+                   all numeric columns if None
+        - static : Use the mean production over all years for every year (see ProductionWeights.matrix)
+    Returns a Pandas DataFrame indexed by ([AgVar,] [State,] Year) with one column per model
+    """
+    weights = weights if weights is not None else load_weights()
+    if data.index.names != [None]:
+        data = data.reset_index()
+    keys = [key for key in ['AgVar', 'GEOID', 'Year'] if key in data.columns]
+    if models is None:
+        models = [col for col in data.columns if col not in keys and pd.api.types.is_numeric_dtype(data[col])]
+    # Positions of the distinct GEOIDs only
+    geoid, unique = pd.factorize(data['GEOID'])
+    county = weights.counties.positions(unique)[geoid]
+    data = data[county >= 0]
+    county = county[county >= 0]
+    # Output rows: group x (AgVar, Year), coded from the codes of each key
+    others = [key for key in keys if key != 'GEOID']
+    factors = [pd.factorize(data[key], sort=True) for key in others]
+    codes = np.ravel_multi_index([code for code, _ in factors], [len(uniques) for _, uniques in factors])
+    combined, codes = np.unique(codes, return_inverse=True)
+    combined = np.unravel_index(combined, [len(uniques) for _, uniques in factors])
+    labels = pd.MultiIndex.from_arrays([uniques[pos] for (_, uniques), pos in zip(factors, combined)], names=others)
+    group, names = weights.groups(level)
+    rows = group[county] * len(labels) + codes
+    # Production of each county in the year of each row
+    years = pd.Index(labels.get_level_values('Year'))
+    share = weights.matrix(years, static)[codes, county]
+    values = data[models].to_numpy(dtype=float)
+    valid = ~np.isnan(values)
+    member = sparse.csr_matrix((share, (rows, np.arange(len(rows)))), shape=(len(names) * len(labels), len(rows)))
+    total = member @ np.where(valid, values, 0.)
+    norm = member @ valid.astype(float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        result = np.where(norm > 0., total / norm, np.nan)
+    index = pd.MultiIndex.from_tuples([(name,) + tuple(label) for name in names for label in labels],
+                                      names=[names.name] + others)
+    out = pd.DataFrame(result, index=index, columns=pd.Index(models))
+    if level == 'national':
+        out = out.droplevel(names.name)
+    order = [name for name in ['AgVar', 'State', 'Year'] if name in out.index.names]
+    return (out.reorder_levels(order) if len(order) > 1 else out).sort_index()
@@ -0,0 +1,172 @@
+import json
+import os
+import sys
+import tempfile
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(HERE, "usda_grab"))
+import county
+import quickstats
+import trends
+
+YIELDS = os.path.join(HERE, "usda_grab/output/USDA_county_yields.csv")
+TRENDS = os.path.join(HERE, "final/USDA_county_yields_w_county_quad_trends.csv")
+
+# Latest year ingested per state, next to the county yields
+STATE_FILE = os.path.join(HERE, "usda_grab/output/latest_years.json")
+
+STATE_FIPS = {"AL": "01", "AK": "02", "AZ": "04", "AR": "05", "CA": "06", "CO": "08", "CT": "09", "DE": "10",
+              "FL": "12", "GA": "13", "HI": "15", "ID": "16", "IL": "17", "IN": "18", "IA": "19", "KS": "20",
+              "KY": "21", "LA": "22", "ME": "23", "MD": "24", "MA": "25", "MI": "26", "MN": "27", "MS": "28",
+              "MO": "29", "MT": "30", "NE": "31", "NV": "32", "NH": "33", "NJ": "34", "NM": "35", "NY": "36",
+              "NC": "37", "ND": "38", "OH": "39", "OK": "40", "OR": "41", "PA": "42", "RI": "44", "SC": "45",
+              "SD": "46", "TN": "47", "TX": "48", "UT": "49", "VT": "50", "VA": "51", "WA": "53", "WV": "54",
+              "WI": "55", "WY": "56"}
+
+
+def _key(df):
+    # 7 character GEOID of a USDA table, whatever the dtypes it was read with
+    return (df["state_fips_code"].astype(str).str.zfill(2) + df["county_code"].astype(str).str.zfill(3)
+            + df["asd_code"].astype(str).str.zfill(2))
+
+
+def read_yields(path=YIELDS):
+    """
+    USDA_county_yields.csv with its 7 character GEOIDs as strings
+    """
+    codes = {"GEOID": 7, "state_fips_code": 2, "county_code": 3, "asd_code": 2}
+    usda = pd.read_csv(path, dtype={col: str for col in codes})
+    for col, width in codes.items():
+        usda[col] = usda[col].str.zfill(width)
+    return usda
+
+
+def latest_years(usda_county):
+    """
+    Latest year with a positive yield or area of each state (by state_alpha) in county yields
+    """
+    data = usda_county[(usda_county["Value"] > 0.0) | (usda_county["area"] > 0.0)]
+    latest = data.groupby(data["GEOID"].str[:2])["year"].max()
+    return {alpha: int(latest[fips]) for alpha, fips in STATE_FIPS.items() if fips in latest.index}
+
+
+def read_state(path=STATE_FILE, usda_county=None):
+    """
+    Latest year ingested per state, derived from the county yields if no refresh recorded it yet
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return latest_years(usda_county) if usda_county is not None else {}
+
+
+def merge(usda_county, delta):
+    """
+    Merge the (GEOID, year) rows of 'delta' into 'usda_county'
+
+    Rows missing from 'usda_county' are appended, and its zero-filled placeholder rows
+    (Value and area 0, as the complete county x year grid has for years without data) are
+    replaced by the new ones. Other existing rows are kept as they are and win over new ones,
+    as the drop_duplicates(subset=["GEOID", "year"], keep="first") of USDA_processing.ipynb.
+    Returns (merged DataFrame, GEOIDs whose positive yields changed)
+    """
+    delta = delta.drop_duplicates(subset=["GEOID", "year"], keep="first").reset_index(drop=True)
+    keys = pd.MultiIndex.from_frame(delta[["GEOID", "year"]])
+    pos = keys.get_indexer(pd.MultiIndex.from_frame(usda_county[["GEOID", "year"]]))
+    placeholder = (usda_county["Value"] == 0.0) & (usda_county["area"] == 0.0)
+    # Fill the placeholders in place, keeping the row order
+    replace = (pos >= 0) & placeholder.to_numpy()
+    usda_county = usda_county.copy()
+    for col in [col for col in delta.columns if col in usda_county.columns]:
+        usda_county.loc[replace, col] = delta[col].to_numpy()[pos[replace]]
+    new = delta[~np.isin(np.arange(len(delta)), pos[pos >= 0])]
+    updated = pd.concat([delta.iloc[pos[replace]], new])
+    changed = np.unique(updated.loc[updated["Value"] > 0.0, "GEOID"])
+    columns = usda_county.columns.union(new.columns, sort=False)
+    return pd.concat([usda_county, new], ignore_index=True)[columns], changed
+
+
+def update_trends(usda_county, changed, path=TRENDS, frac=0.5):
+    """
+    Recompute the county trends of the 'changed' GEOIDs only and replace their rows in 'path'
+    """
+    old = pd.read_csv(path)
+    fits = trends.notebook_codes(trends.CountyTrends(usda_county, changed, frac))
+    keep = old[~_key(old).isin(changed)]
+    columns = old.columns.union(fits.columns, sort=False)
+    out = pd.concat([keep, fits[[col for col in columns if col in fits.columns]]], ignore_index=True)[columns]
+    out["year"] = out["year"].astype(int)
+    out = out.assign(_key=_key(out)).sort_values(["_key", "year"], kind="stable").drop(columns="_key")
+    _write_atomic(out, path)
+    return out
+
+
+def Refresh(client=None, states=quickstats.state_alphas, yields_path=YIELDS, trends_path=TRENDS,
+            state_path=STATE_FILE, counties=None, changes=None):
+    """
+    Incremental update of the USDA county yields and their county trends
+
+    Only the years after the latest one ingested for each state are requested. New county x
+    year rows are processed as in usda_county_api.ipynb and merged into the county yields,
+    filling their zero placeholder rows (see merge), and the trends are recomputed only for the counties
+    whose yields changed. The latest year of each state is recorded in 'state_path'.
+    State trends (USDA_state_yields.csv) still come from usda_state_api.ipynb.
+
+    Inputs:
+        - client : quickstats.Client, a default one if None
+        - states : States to refresh
+        - yields_path : USDA_county_yields.csv to update
+        - trends_path : USDA_county_yields_w_county_quad_trends.csv to update, skipped if None
+        - state_path : JSON file of the latest year ingested per state
+        - counties/changes : County list and GEOID updates (see county.read_counties / read_changes)
+    Returns the GEOIDs whose yields changed
+    """
+    client = client or quickstats.Client()
+    counties = county.read_counties() if counties is None else counties
+    changes = county.read_changes() if changes is None else changes
+    usda = read_yields(yields_path)
+    latest = read_state(state_path, usda)
+    since = {state: latest.get(state, 1949) + 1 for state in states}
+
+    # Cached answers may predate new releases or revisions, so ask again
+    usda_county = client.get("yield", "COUNTY", states, since, refresh=True)
+    usda_county_area = client.get("area", "COUNTY", states, since, refresh=True)
+    if usda_county.empty and usda_county_area.empty:
+        print("No new years")
+        return np.array([], dtype=str)
+    fetched = pd.concat([usda_county[["state_alpha", "year"]], usda_county_area[["state_alpha", "year"]]])
+    fetched = fetched.groupby("state_alpha")["year"].max()
+
+    # Rows of the new years only, for the states with new records
+    fips = [STATE_FIPS[state] for state in fetched.index]
+    counties = counties[counties["State"].isin(fips)]
+    delta = county.ProcessCounty(usda_county, usda_county_area, counties, changes,
+                                 np.arange(min(since[state] for state in fetched.index), fetched.max() + 1))
+    end = delta["GEOID"].str[:2].map({STATE_FIPS[state]: year for state, year in fetched.items()})
+    start = delta["GEOID"].str[:2].map({STATE_FIPS[state]: since[state] for state in fetched.index})
+    delta = delta[(delta["year"] >= start) & (delta["year"] <= end)]
+
+    usda, changed = merge(usda, delta)
+    _write_atomic(usda, yields_path)
+    if trends_path is not None and len(changed):
+        update_trends(usda, changed, trends_path)
+    latest.update({state: int(year) for state, year in fetched.items()})
+    _write_atomic(latest, state_path)
+    return changed
+
+
+def _write_atomic(data, path):
+    # Write a DataFrame (CSV) or dict (JSON) to a temporary file next to 'path' and move it into place
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            if isinstance(data, pd.DataFrame):
+                data.to_csv(f, index=False)
+            else:
+                json.dump(data, f, indent=1, sort_keys=True)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+
+# Trend columns of USDA_county_yields_w_county_quad_trends.csv
+TRENDS = ["log_Value", "lowess_log_Value", "quad_fit", "quad_fit_nolog", "target_Value", "target_ValueQ",
+          "target_ValueQnl"]
+
+# Trend columns of USDA_county_yields_w_county_trends.csv (lowess only)
+LOWESS_TRENDS = ["log_Value", "lowess_log_Value", "target_Value"]
+
+
+def year_matrix(usda_county):
+    """
+    County x year matrix of yields, NaN where a county has no yield
+
+    Inputs:
+        - usda_county : Pandas DataFrame with GEOID, year and Value, one row per (GEOID, year)
+    Returns (rows, cols, GEOIDs, years, matrix): the matrix position of each row of
+    'usda_county', the GEOIDs in order of appearance and the sorted years
+    """
+    rows, geoids = pd.factorize(usda_county["GEOID"])
+    years, cols = np.unique(usda_county["year"].to_numpy(), return_inverse=True)
+    matrix = np.full((len(geoids), len(years)), np.nan)
+    matrix[rows, cols] = usda_county["Value"].to_numpy(dtype=float)
+    return rows, cols, geoids, years, matrix
+
+
+def quad_trends(years, values):
+    """
+    Quadratic trends of every county at once, the np.polyfit(year, value, 2) of each row
+
+    The fits are batched least squares over the county x year matrix, the missing years
+    having no weight. Years are centred and scaled, which leaves the fitted values unchanged
+    but keeps the normal equations well conditioned.
+
+    Inputs:
+        - years : Years of the columns
+        - values : County x year matrix, NaN where missing
+    Returns the fitted values as a county x year matrix, 0 for counties with a single year
+    """
+    mask = ~np.isnan(values)
+    x = (years - years.mean()) / (np.ptp(years) or 1.)
+    design = np.stack([np.ones_like(x), x, x ** 2], axis=-1)
+    y = np.where(mask, values, 0.)
+    normal = np.einsum("ct,ti,tj->cij", mask.astype(float), design, design)
+    rhs = np.einsum("ct,ti->ci", y, design)
+    # The pseudo-inverse gives the least squares projection of counties with fewer than 3 years too
+    coeffs = np.einsum("cij,cj->ci", np.linalg.pinv(normal, rcond=1e-10, hermitian=True), rhs)
+    fit = coeffs @ design.T
+    return np.where(mask.sum(axis=1, keepdims=True) > 1, fit, 0.)
+
+
+def _tricube(d):
+    # Tricube kernel, cubes as products as in statsmodels
+    c = 1. - d * d * d
+    return c * c * c
+
+
+def batch_lowess(x, y, n, frac=0.5, it=3):
+    """
+    Lowess fits of many series at once, following statsmodels.nonparametric.lowess (delta=0)
+
+    Each series is fitted at its own points by local linear regressions over its k = frac * n
+    nearest points, with 'it' robustifying iterations, as statsmodels' implementation but
+    over a (series x point x neighbour) array.
+
+    Inputs:
+        - x : Series x point array of increasing x-values (distinct), padded after the n valid points
+        - y : Series x point array of y-values
+        - n : Number of valid points of each series (at least 2)
+        - frac : Fraction of the points used for each fit
+        - it : Number of residual-based reweightings
+    Returns (fitted values, NaN at padded points, and a flag of the series whose median
+    absolute residual fell to rounding level, where the robustness weights are set by
+    rounding errors and so depend on the order of the floating point operations)
+    """
+    npts = x.shape[1]
+    pos = np.arange(npts)
+    valid = pos < n[:, None]
+    x = np.where(valid, x, np.inf)
+    y = np.where(valid, y, 0.)
+    k = np.clip((frac * n + 1e-10).astype(int), 2, n)[:, None]
+
+    # Left end of each point's neighbourhood, where statsmodels stops sliding it
+    right = np.take_along_axis(x, np.minimum(pos[None, :] + k, npts - 1), axis=1)
+    mid = (x + right) / 2.
+    slide = (pos[None, :] < (n[:, None] - k))[:, None, :] & (x[:, :, None] > mid[:, None, :])
+    left = slide.sum(axis=2)
+    window = (pos[None, None, :] >= left[:, :, None]) & (pos[None, None, :] < (left + k)[:, :, None])
+    xl = np.take_along_axis(x, left, axis=1)
+    xr = np.take_along_axis(x, np.minimum(left + k - 1, npts - 1), axis=1)
+    radius = np.fmax(x - xl, xr - x)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        kernel = np.where(window, _tricube(np.abs(x[:, None, :] - x[:, :, None]) / radius[:, :, None]), 0.)
+
+    resid_weights = np.ones_like(y)
+    degenerate = np.zeros(len(x), dtype=bool)
+    for robiter in range(it + 1):
+        weights = kernel * resid_weights[:, None, :]
+        ok = (weights > 1e-12).sum(axis=2) >= 2
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weights = weights / weights.sum(axis=2, keepdims=True)
+            xj = np.where(window, x[:, None, :], 0.)
+            mean = (weights * xj).sum(axis=2)
+            dev = np.where(window, xj - mean[:, :, None], 0.)
+            var = np.fmax((weights * dev ** 2).sum(axis=2), 1e-12)
+            p = weights * (1. + (x - mean)[:, :, None] * dev / var[:, :, None])
+            fit = np.where(ok, (p * y[:, None, :]).sum(axis=2), y)
+        if robiter < it:
+            # Bisquare weights of the residuals, relative to 6 median absolute residuals
+            resid = np.where(valid, np.abs(y - fit), np.nan)
+            median = np.nanmedian(resid, axis=1, keepdims=True)
+            degenerate |= median[:, 0] < 1e-10 * np.abs(y).max(axis=1)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                scaled = np.where(median == 0., (resid > 0.).astype(float), resid / (6. * median))
+            scaled = np.fmin(scaled, 1.)
+            resid_weights = np.where(valid, (1. - scaled * scaled) ** 2, 0.)
+    return np.where(valid, fit, np.nan), degenerate
+
+
+def lowess_trends(years, values, frac=0.5, chunk=500):
+    """
+    Lowess trends of every county, the sm.nonparametric.lowess(value, year, frac=frac) of each row
+
+    Inputs:
+        - years : Sorted years of the columns
+        - values : County x year matrix, NaN where missing
+        - frac : Fraction of the data used for each fit
+        - chunk : Number of counties fitted together, bounding memory
+    Counties whose fit is degenerate (see batch_lowess) are refitted with statsmodels, to give
+    its results there too.
+    Returns the fitted values as a county x year matrix, 0 for counties with a single year
+    """
+    out = np.zeros_like(values)
+    mask = ~np.isnan(values)
+    n = mask.sum(axis=1)
+    fitted = np.flatnonzero(n > 1)
+    for start in range(0, len(fitted), chunk):
+        rows = fitted[start:start + chunk]
+        # Valid years of each county first, in order
+        order = np.argsort(~mask[rows], axis=1, kind="stable")
+        x = years.astype(float)[order]
+        y = np.take_along_axis(values[rows], order, axis=1)
+        fit, degenerate = batch_lowess(x, y, n[rows], frac)
+        valid = np.arange(values.shape[1]) < n[rows, None]
+        out[rows[:, None].repeat(values.shape[1], axis=1)[valid], order[valid]] = fit[valid]
+        if degenerate.any():
+            import statsmodels.api as sm
+        for row in rows[degenerate]:
+            out[row, mask[row]] = sm.nonparametric.lowess(values[row, mask[row]], years[mask[row]], frac=frac)[:, 1]
+    return out
+
+
+def CountyTrends(usda_county, geoids=None, frac=0.5, quad=True):
+    """
+    County yields with their lowess and quadratic trends, as in USDA_processing.ipynb
+
+    All counties are fitted at once on a county x year matrix and the trends joined to the
+    yields in one step.
+
+    Inputs:
+        - usda_county : Pandas DataFrame of USDA_county_yields.csv, duplicated (GEOID, year)
+                        keeping the first as in USDA_processing.ipynb
+        - geoids : Counties to fit, all if None
+        - frac : Fraction of the data used by lowess
+        - quad : Add the quadratic trends (TRENDS columns, ..._w_county_quad_trends.csv), or
+                 only lowess ones (LOWESS_TRENDS columns, ..._w_county_trends.csv)
+    Returns the positive yields of the counties with the trend columns added
+    """
+    usda_county = usda_county.drop_duplicates(subset=["GEOID", "year"], keep="first")
+    usda_county = usda_county[usda_county["Value"] > 0.0]
+    if geoids is not None:
+        usda_county = usda_county[usda_county["GEOID"].isin(geoids)]
+    rows, cols, _, years, values = year_matrix(usda_county)
+    log_values = np.log(values)
+    fits = {"log_Value": log_values, "lowess_log_Value": lowess_trends(years, log_values, frac)}
+    if quad:
+        fits["quad_fit"] = quad_trends(years, log_values)
+        fits["quad_fit_nolog"] = quad_trends(years, values)
+    out = pd.DataFrame({name: fit[rows, cols] for name, fit in fits.items()}, index=usda_county.index)
+    out["target_Value"] = out["log_Value"] - out["lowess_log_Value"]
+    if quad:
+        out["target_ValueQ"] = out["log_Value"] - out["quad_fit"]
+        out["target_ValueQnl"] = usda_county["Value"] - out["quad_fit_nolog"]
+    return usda_county.join(out[TRENDS if quad else LOWESS_TRENDS])
+
+
+def notebook_codes(trends):
+    """
+    GEOID and codes of county trends as written by USDA_processing.ipynb, i.e. integers
+    (GEOID without leading zeros)
+    """
+    trends = trends.copy()
+    trends["GEOID"] = trends["GEOID"].astype(str).str.lstrip("0")
+    for col in ["state_fips_code", "county_code", "asd_code"]:
+        trends[col] = trends[col].astype(int)
+    return trends
+
+
+def SaveTrends(usda_county, quad_path, lowess_path=None, frac=0.5):
+    """
+    Rebuild USDA_county_yields_w_county_quad_trends.csv (and ..._w_county_trends.csv if
+    'lowess_path' is given) from the county yields, fitting the lowess trends only once
+    """
+    fits = notebook_codes(CountyTrends(usda_county, frac=frac))
+    fits.to_csv(quad_path, index=False)
+    if lowess_path is not None:
+        fits.drop(columns=[col for col in TRENDS if col not in LOWESS_TRENDS]).to_csv(lowess_path, index=False)
+    return fits
@@ -0,0 +1,91 @@
+import os
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# USDA county lists of usda_county_api.ipynb
+COUNTY_LIST = os.path.join(HERE, "input/county_district_list.csv")
+COUNTY_CHANGES = os.path.join(HERE, "input/counties_old.csv")
+
+OTHER = "OTHER (COMBINED) COUNTIES"
+
+
+def _geoid(df, state="State", county="County", district="District"):
+    # 7 character GEOID of state, county and agricultural district codes
+    return (df[state].astype(str).str.zfill(2) + df[county].astype(str).str.zfill(3)
+            + df[district].astype(str).str.zfill(2))
+
+
+def read_counties(path=COUNTY_LIST):
+    """
+    Current USDA counties in use, with 'State', 'County', 'District' codes and 'GEOID'
+    """
+    counties = pd.read_csv(path)
+    counties = counties[(counties.Use == 1.0) & (counties.District != 0) & (counties.Name != "State Total")].copy()
+    counties["State"] = counties["State"].astype(str).str.zfill(2)
+    counties["County"] = counties["County"].astype(str).str.zfill(3)
+    counties["District"] = counties["District"].astype(str).str.zfill(2)
+    counties["GEOID"] = _geoid(counties)
+    return counties
+
+
+def read_changes(path=COUNTY_CHANGES):
+    """
+    Pandas Series mapping old GEOIDs to current ones, without the discontinued counties ('0000000')
+    """
+    changes = pd.read_csv(path)
+    new = _geoid(changes, "State_new", "County_new", "District_new")
+    changes = pd.Series(new.to_numpy(), index=_geoid(changes).to_numpy())
+    # Later entries of an old GEOID win, as in the notebook loop
+    changes = changes[changes != "0000000"]
+    return changes[~changes.index.duplicated(keep="last")]
+
+
+def ProcessCounty(usda_county, usda_county_area, counties, changes, years):
+    """
+    County yields and harvested areas as in usda_county_api.ipynb, without row-wise loops
+
+    Old GEOIDs are updated to current ones, every current county gets a row for each of
+    'years' (0 without data), and missing yields or areas are filled from the "OTHER
+    (COMBINED) COUNTIES" results of their agricultural district, the area divided evenly
+    among the district's current counties.
+
+    Inputs:
+        - usda_county/usda_county_area : County yields and areas from quickstats (tidied)
+        - counties : Current counties from read_counties
+        - changes : GEOID updates from read_changes
+        - years : Years of the complete county x year index
+    Returns a Pandas DataFrame with GEOID, year, state_fips_code, county_code, asd_code, Value and area
+    """
+    keys = ["state_fips_code", "year", "asd_code"]
+    yields = usda_county.assign(Value=usda_county["Value"].astype(str).str.replace(",", "").astype(float))
+    areas = usda_county_area.assign(Value=usda_county_area["Value"].astype(str).str.replace(",", "").astype(float))
+
+    # Other (combined) results, areas split among the current counties of each district
+    other = yields[yields["county_name"] == OTHER].groupby(keys)["Value"].sum().rename("OtherCombined_Value")
+    other_area = areas[areas["county_name"] == OTHER].groupby(keys)["Value"].sum()
+    county_num = counties.groupby(["State", "District"]).size()
+    count = county_num.reindex(pd.MultiIndex.from_arrays([other_area.index.get_level_values("state_fips_code"),
+                                                          other_area.index.get_level_values("asd_code")])).to_numpy()
+    other_area = (other_area / count).dropna().rename("OtherMean_Area")
+    other_all = pd.concat([other_area, other], axis=1, join="inner")
+
+    # Main results
+    key = ["GEOID", "year"]
+    yields = yields[yields["county_name"] != OTHER].assign(GEOID=_geoid(yields, "state_fips_code", "county_code", "asd_code"))
+    areas = areas[areas["county_name"] != OTHER].assign(GEOID=_geoid(areas, "state_fips_code", "county_code", "asd_code"))
+    usda = pd.merge(yields[key + ["Value"]], areas[key + ["Value"]].rename(columns={"Value": "area"}), on=key, how="outer")
+    usda["GEOID"] = usda["GEOID"].map(changes).fillna(usda["GEOID"])
+
+    # Complete county x year index, then fill from the other (combined) results
+    index = pd.MultiIndex.from_product([counties["GEOID"].unique(), years], names=key).to_frame(index=False)
+    usda = pd.merge(index, usda, on=key, how="outer")
+    usda["state_fips_code"] = usda["GEOID"].str[:2]
+    usda["county_code"] = usda["GEOID"].str[2:5]
+    usda["asd_code"] = usda["GEOID"].str[-2:]
+    usda = usda.sort_values(key, kind="stable").fillna({"Value": 0.0, "area": 0.0})
+    usda = usda.join(other_all, on=keys).fillna({"OtherCombined_Value": 0.0, "OtherMean_Area": 0.0})
+    usda["area"] = np.where(usda["area"] > 0.0, usda["area"], usda["OtherMean_Area"])
+    usda["Value"] = np.where(usda["Value"] > 0.0, usda["Value"], usda["OtherCombined_Value"])
+    return usda[key + ["state_fips_code", "county_code", "asd_code", "Value", "area"]].reset_index(drop=True)
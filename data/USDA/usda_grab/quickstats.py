@@ -0,0 +1,211 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import requests
+
+API_URL = "https://quickstats.nass.usda.gov/api/api_GET/"
+
+# Default directory of cached responses, next to this module
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+# Environment variable holding the QuickStats API key
+API_KEY = "NASS_API_KEY"
+
+state_alphas = ["AL","AK","AZ","AR","CA","CO","CT","DE","FL","GA","HI","ID","IL","IN","IA","KS","KY","LA","ME","MD","MA","MI","MN","MS","MO","MT","NE","NV","NH","NJ","NM","NY","NC","ND","OH","OK","OR","PA","RI","SC","SD","TN","TX","UT","VT","VA","WA","WV","WI","WY"]
+
+# Corn statistics as in the usda_*_api notebooks
+STATISTICS = {"yield": {"statisticcat_desc": "YIELD", "unit_desc": "BU / ACRE"},
+              "area": {"statisticcat_desc": "AREA HARVESTED", "unit_desc": "ACRES"}}
+
+# Columns dropped by tidy, and the extra ones at each level
+DROP = ["CV (%)", "agg_level_desc", "asd_desc", "begin_code", "class_desc", "commodity_desc", "congr_district_code",
+        "country_code", "country_name", "domain_desc", "domaincat_desc", "end_code", "freq_desc", "group_desc",
+        "load_time", "location_desc", "prodn_practice_desc", "reference_period_desc", "region_desc", "sector_desc",
+        "short_desc", "source_desc", "statisticcat_desc", "unit_desc", "util_practice_desc", "watershed_code",
+        "watershed_desc", "week_ending", "zip_5", "county_ansi", "state_ansi"]
+DROP_LEVEL = {"COUNTY": [], "STATE": ["asd_code", "county_code", "county_name"],
+              "NATIONAL": ["asd_code", "county_code", "county_name"]}
+
+# Responses worth retrying
+RETRY_STATUS = [429, 500, 502, 503, 504]
+
+
+def query(statistic, level, year_min=1950):
+    """
+    QuickStats parameters of a corn statistic ('yield' or 'area') at a level ('COUNTY', 'STATE' or 'NATIONAL')
+    """
+    params = {"source_desc": "SURVEY", "sector_desc": "CROPS", "group_desc": "FIELD CROPS", "commodity_desc": "CORN",
+              "util_practice_desc": "GRAIN", "agg_level_desc": level, "year__GE": year_min}
+    params.update(STATISTICS[statistic])
+    if level != "COUNTY":
+        params.update({"prodn_practice_desc": "ALL PRODUCTION PRACTICES", "reference_period_desc": "YEAR"})
+    return params
+
+
+def tidy(df, level):
+    """
+    Drop the descriptive QuickStats columns
+    """
+    return df.drop(columns=DROP + DROP_LEVEL[level], errors="ignore")
+
+
+class Client:
+    """
+    QuickStats client with a pooled session, bounded concurrency, retries and an on-disk cache
+
+    Inputs:
+        - key : API key, read from the NASS_API_KEY environment variable if None
+        - url : API endpoint (e.g. a stub.StubServer url for tests)
+        - cache_dir : Directory of cached responses keyed by query parameters, no cache if None
+        - max_age : Age (s) after which cached responses are requested again, never if None
+        - max_workers : Number of concurrent requests
+        - retries : Attempts after the first on connection errors, RETRY_STATUS responses and
+                    200 responses without valid "data" JSON
+        - backoff : Base delay (s) of the exponential backoff between attempts
+    """
+
+    def __init__(self, key=None, url=API_URL, cache_dir=CACHE_DIR, max_age=None, max_workers=8, retries=5,
+                 backoff=1.):
+        self.key = key if key is not None else os.environ.get(API_KEY)
+        if not self.key:
+            raise ValueError("No QuickStats API key, set the " + API_KEY + " environment variable")
+        self.url = url
+        self.cache_dir = cache_dir
+        self.max_age = max_age
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _cache_path(self, params):
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".json")
+
+    def request(self, params, refresh=False):
+        """
+        Return the records of one query, from the cache if present, not older than max_age
+        and not 'refresh'. Fresh answers replace the cached ones.
+
+        A 400 response with QuickStats' "no data" error gives no records, any other 400 (e.g. a
+        bad parameter name or value) raises. Connection errors, RETRY_STATUS responses and 200
+        responses without valid "data" JSON are retried and raise once the attempts are exhausted.
+        """
+        path = self._cache_path(params) if self.cache_dir else None
+        if (path and not refresh and os.path.exists(path)
+                and (self.max_age is None or time.time() - os.path.getmtime(path) <= self.max_age)):
+            with open(path) as f:
+                return json.load(f)
+        for attempt in range(self.retries + 1):
+            try:
+                res = self.session.get(self.url, params=dict(params, key=self.key), timeout=120)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == self.retries:
+                    raise
+            else:
+                if res.status_code == 200:
+                    data = _records(res)
+                    if data is not None:
+                        break
+                    # Truncated or malformed answer, asked again
+                    if attempt == self.retries:
+                        raise requests.HTTPError("QuickStats answer without data for "
+                                                 + json.dumps(params, default=str), response=res)
+                elif res.status_code == 400 and _no_data(res):
+                    data = []
+                    break
+                elif res.status_code not in RETRY_STATUS or attempt == self.retries:
+                    # Name the query, not the url, which holds the key
+                    raise requests.HTTPError("QuickStats error " + str(res.status_code) + " " + _error(res)
+                                             + " for " + json.dumps(params, default=str), response=res)
+            time.sleep(self.backoff * 2 ** attempt)
+        # Empty answers are not cached, so they are asked again next time
+        if path and data:
+            _write_atomic(data, path)
+        return data
+
+    def fetch(self, queries, refresh=False):
+        """
+        Run queries concurrently and return the records of all as a single DataFrame,
+        bypassing the cache if 'refresh'
+
+        Every query is either fetched or raises, so no state is silently lost. Queries
+        without records are reported.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            results = list(executor.map(lambda params: self.request(params, refresh), queries))
+        for params, data in zip(queries, results):
+            if not data:
+                print("No records for " + json.dumps(params, default=str))
+        return pd.DataFrame([row for data in results for row in data])
+
+    def get(self, statistic, level, states=state_alphas, year_min=1950, refresh=False):
+        """
+        Corn statistic ('yield' or 'area') at a level for all states, tidied as in the notebooks
+
+        'year_min' is the first year to request, or a dict of it per state (e.g. for an
+        incremental refresh), states missing from the dict starting in 1950. 'refresh' requests
+        every query again instead of reading cached responses.
+        """
+        if level == "NATIONAL":
+            queries = [query(statistic, level, year_min)]
+        elif isinstance(year_min, dict):
+            queries = [dict(query(statistic, level, year_min.get(state, 1950)), state_alpha=state) for state in states]
+        else:
+            queries = [dict(query(statistic, level, year_min), state_alpha=state) for state in states]
+        return tidy(self.fetch(queries, refresh), level)
+
+
+def get_corn(states, level, client=None):
+    """
+    Corn yields of all 'states' at 'level' ('COUNTY' or 'STATE')
+    """
+    return (client or Client()).get("yield", level, states)
+
+
+def get_corn_area(states, level, client=None):
+    """
+    Corn harvested areas of all 'states' at 'level' ('COUNTY' or 'STATE')
+    """
+    return (client or Client()).get("area", level, states)
+
+
+def _records(res):
+    # Records of a 200 response, None if its body is not JSON with a "data" list
+    try:
+        data = res.json()["data"]
+    except (ValueError, KeyError, TypeError):
+        return None
+    return data if isinstance(data, list) else None
+
+
+def _error(res):
+    # Error message of a QuickStats response, e.g. ["bad request - no data"]
+    try:
+        return json.dumps(res.json()["error"])
+    except (ValueError, KeyError, TypeError):
+        return res.text[:200]
+
+
+def _no_data(res):
+    # Whether a 400 response is QuickStats' answer to a valid query without records
+    return "no data" in _error(res).lower()
+
+
+def _write_atomic(data, path):
+    # Write JSON to a temporary file next to 'path' and move it into place
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -0,0 +1,65 @@
+import json
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qsl
+
+
+class StubServer:
+    """
+    Local stand-in for the QuickStats API, to exercise quickstats.Client without the network
+
+    Used as a context manager, it serves on a free local port (see 'url'). Queries answer
+    {"data": records(params)}, 400 when there are no records, 401 without a key, and 503
+    for the first 'fail' requests of each query to exercise retries.
+
+    Inputs:
+        - records : Function of the query parameters (dict) returning a list of records
+        - fail : Number of 503 responses before each query succeeds
+    """
+
+    def __init__(self, records, fail=0):
+        self.records = records
+        self.fail = fail
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = dict(parse_qsl(urlparse(self.path).query))
+                key = params.pop("key", None)
+                query = tuple(sorted(params.items()))
+                with stub._lock:
+                    stub.calls[query] += 1
+                    count = stub.calls[query]
+                if not key:
+                    return self._send(401, {"error": ["unauthorized"]})
+                if count <= stub.fail:
+                    return self._send(503, {"error": ["unavailable"]})
+                data = stub.records(params)
+                if not data:
+                    return self._send(400, {"error": ["bad request - no data"]})
+                self._send(200, {"data": data})
+
+            def _send(self, status, body):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/api/api_GET/".format(self.server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
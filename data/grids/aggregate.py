@@ -0,0 +1,181 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+from scipy import sparse
+
+
+def weight_matrix(weights, shape, geoids=None):
+    """
+    Sparse (county x grid cell) matrix of within-county weights
+
+    Grid cells are numbered over the flattened (lat, lon) grid, i.e. lat * nlon + lon.
+
+    Inputs:
+        - weights : Pandas DataFrame of a counties_*_weighted.csv (GEOID, latitude, longitude,
+                    within_county_weight), pieces of the same cell are summed
+        - shape : (nlat, nlon) of the full grid the latitude/longitude indices refer to
+        - geoids : Counties (rows) of the matrix, defaults to the sorted GEOIDs of 'weights'
+    Returns (matrix, geoids)
+    """
+    geoid = weights['GEOID'].astype(str).str.zfill(5)
+    geoids = pd.Index(sorted(geoid.unique()) if geoids is None else geoids, name='GEOID')
+    rows = geoids.get_indexer(geoid)
+    cols = weights['latitude'].to_numpy() * shape[1] + weights['longitude'].to_numpy()
+    keep = rows >= 0
+    matrix = sparse.coo_matrix((weights['within_county_weight'].to_numpy(dtype=float)[keep],
+                                (rows[keep], cols[keep])), shape=(len(geoids), shape[0] * shape[1]))
+    return matrix.tocsr(), geoids
+
+
+def load_matrix(path, shape):
+    """
+    Weight matrix of a counties_*_weighted.csv, cached next to it as '<name>_matrix.npz'
+
+    The cache is rebuilt when the CSV is newer or the grid shape differs.
+    """
+    cache = os.path.splitext(path)[0] + '_matrix.npz'
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(path):
+        with np.load(cache, allow_pickle=False) as f:
+            if tuple(f['grid']) == tuple(shape):
+                matrix = sparse.csr_matrix((f['data'], f['indices'], f['indptr']), shape=tuple(f['shape']))
+                return matrix, pd.Index(f['geoids'], name='GEOID')
+    matrix, geoids = weight_matrix(pd.read_csv(path, dtype={'GEOID': str}), shape)
+    # Unique temporary file, as concurrent jobs on the same grid may build the cache at once
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, data=matrix.data, indices=matrix.indices, indptr=matrix.indptr, shape=matrix.shape,
+                     grid=shape, geoids=np.asarray(geoids, dtype=str))
+        os.replace(tmp, cache)
+    except BaseException:
+        os.remove(tmp)
+        raise
+    return matrix, geoids
+
+
+def aggregate(matrix, field, lat='lat', lon='lon'):
+    """
+    Weighted county means of a gridded field as one sparse-dense product
+
+    Cells with NaN values propagate NaN to the counties that use them.
+
+    Inputs:
+        - matrix : Weight matrix from weight_matrix / load_matrix
+        - field : xarray DataArray with 'lat' and 'lon' dimensions, any others (e.g. time) kept
+    Returns an array of shape (counties, other dimensions...)
+    """
+    other = [dim for dim in field.dims if dim not in (lat, lon)]
+    values = field.transpose(*other, lat, lon).values
+    flat = values.reshape(-1, values.shape[-2] * values.shape[-1])
+    return (matrix @ flat.T).reshape((matrix.shape[0],) + values.shape[:-2])
+
+
+def _years(time):
+    # Years of a time coordinate, which may already hold years
+    if np.issubdtype(time.dtype, np.number):
+        return time.values
+    return time.dt.year.values
+
+
+def CountySeries(data, path, variables=None, time='time', lat='lat', lon='lon'):
+    """
+    County time series of gridded variables (e.g. GMFD or NEX/CMIP gdd, egdd, prcp or yield impact)
+
+    Inputs:
+        - data : xarray Dataset (or path to a netCDF file) with 'time', 'lat' and 'lon' dimensions
+        - path : counties_*_weighted.csv on the same grid
+        - variables : Variables to aggregate, defaults to all with lat/lon dimensions
+    Returns a Pandas DataFrame indexed by (GEOID, Year) with one column per variable
+    """
+    if isinstance(data, str):
+        data = xr.open_dataset(data)
+    if variables is None:
+        variables = [name for name in data.data_vars if {lat, lon} <= set(data[name].dims)]
+    matrix, geoids = load_matrix(path, (data.sizes[lat], data.sizes[lon]))
+    years = _years(data[time])
+    index = pd.MultiIndex.from_product([geoids, years], names=['GEOID', 'Year'])
+    return pd.DataFrame({name: aggregate(matrix, data[name].transpose(time, lat, lon), lat, lon).ravel()
+                         for name in variables}, index=index)
+
+
+def crop(matrix, shape):
+    """
+    Smallest (lat, lon) window of the grid holding every weighted cell, and the matrix over it
+
+    Returns (lat slice, lon slice, matrix) with the columns numbered over the window.
+    """
+    cols = np.unique(matrix.indices)
+    lats, lons = np.divmod(cols, shape[1])
+    window = (slice(lats.min(), lats.max() + 1), slice(lons.min(), lons.max() + 1))
+    lat_idx, lon_idx = np.meshgrid(np.arange(shape[0])[window[0]], np.arange(shape[1])[window[1]], indexing='ij')
+    return window[0], window[1], matrix[:, (lat_idx * shape[1] + lon_idx).ravel()]
+
+
+def read_chunks(sources, chunk=10, overlap=0, time='time', lat='lat', lon='lon', window=None):
+    """
+    Iterate over blocks of years of several NetCDF variables, reading only the cropped window
+
+    Inputs:
+        - sources : Dict of name : (path, variable), e.g. {'gdd': ('GDD_10-29C_gs_GMFD.nc', 'GDD')}
+        - chunk : Number of time steps per block
+        - overlap : Number of earlier time steps repeated at the start of each block (e.g. 1
+                    for year-on-year differences)
+        - window : (lat slice, lon slice) to read, e.g. from crop, whole grid if None
+    Yields xarray Datasets holding one variable per source name, loaded into memory
+    """
+    files = {name: xr.open_dataset(path) for name, (path, _) in sources.items()}
+    try:
+        first = next(iter(files.values()))
+        index = {} if window is None else {lat: window[0], lon: window[1]}
+        for start in range(0, first.sizes[time], chunk):
+            steps = slice(max(start - overlap, 0), start + chunk)
+            yield xr.Dataset({name: files[name][var].isel({time: steps, **index}).load()
+                              for name, (_, var) in sources.items()})
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def StreamCounty(sources, path, chunk=10, impact=None, time='time', lat='lat', lon='lon'):
+    """
+    County time series of gridded variables, streamed in blocks of years to bound memory
+
+    Only the grid window holding weighted cells is read, one block of 'chunk' years at a
+    time, and each block is aggregated (and run through the yield response) before the next.
+
+    Inputs:
+        - sources : Dict of name : (path, variable) of the NetCDF inputs (see read_chunks)
+        - path : counties_*_weighted.csv on the same grid
+        - chunk : Number of years per block
+        - impact : Dict of GridImpact keyword arguments (with a single coefficient set) to also
+                   aggregate the yield impact, with sources named 'gdd', 'egdd' and 'prcp'
+    Returns a Pandas DataFrame indexed by (GEOID, Year) with one column per source, plus
+    'prcp2' (the county mean of the squared precipitation) and 'impact' when requested
+    """
+    import response
+    first = next(iter(sources.values()))
+    with xr.open_dataset(first[0]) as f:
+        shape = (f.sizes[lat], f.sizes[lon])
+    matrix, geoids = load_matrix(path, shape)
+    lat_window, lon_window, matrix = crop(matrix, shape)
+    diff = impact is not None and impact.get('diff', True)
+    frames = []
+    for block in read_chunks(sources, chunk, int(diff), time, lat, lon, (lat_window, lon_window)):
+        # Drop the year repeated from the previous block
+        new = slice(1, None) if diff and frames else slice(None)
+        fields = {name: block[name] for name in sources}
+        if 'prcp' in sources:
+            fields['prcp2'] = block['prcp'] ** 2
+        values = {name: aggregate(matrix, field.transpose(time, lat, lon), lat, lon)[:, new]
+                  for name, field in fields.items()}
+        if impact is not None:
+            grid = response.GridImpact(block['gdd'], block['egdd'], block['prcp'], time=time, lon=lon, **impact)
+            values['impact'] = aggregate(matrix, grid, lat, lon)
+            if diff and not frames:
+                # The first year has no difference
+                values['impact'] = np.concatenate([np.full((len(geoids), 1), np.nan), values['impact']], axis=1)
+        index = pd.MultiIndex.from_product([geoids, _years(block[time])[new]], names=['GEOID', 'Year'])
+        frames.append(pd.DataFrame({name: arr.ravel() for name, arr in values.items()}, index=index))
+    return pd.concat(frames).sort_index()
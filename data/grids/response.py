@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+# Longitude (degrees E) of the east/west split of the response functions
+EAST_WEST_LON = 260.
+
+# Response coefficients:
+#   impact = alpha * gdd + beta * egdd + delta1 * prcp - delta2 * prcp^2
+COEFFS = ['alpha', 'beta', 'delta1', 'delta2']
+
+# East coefficients of the GMFD yield calculation (data/GMFD_all/OLDgmfd_yield_calc.ipynb)
+EAST = pd.Series({'alpha': 0.0003151237014, 'beta': 0.006438069467,
+                  'delta1': 0.010282130556877, 'delta2': 0.000081514019725})
+
+# Columns of the fitted regressions (gmfd_regression_res*.csv) and their sign in the response
+REGRESSION = {'GDDc': ('alpha', 1.), 'KDDc': ('beta', 1.), 'Pc': ('delta1', 1.), 'P2c': ('delta2', -1.)}
+
+
+def read_regression(path, dim='GEOID'):
+    """
+    Read fitted coefficient sets (e.g. gmfd_regression_res_60-05_n5k.csv) as response coefficients
+
+    Returns a Pandas DataFrame with the COEFFS columns, indexed by 'dim' (one set per row)
+    """
+    res = pd.read_csv(path)
+    if 'GEOID' in res.columns:
+        res['GEOID'] = res['GEOID'].astype(str).str.zfill(5)
+        res = res.set_index('GEOID')
+    coeffs = pd.DataFrame({name: sign * res[col] for col, (name, sign) in REGRESSION.items()})
+    coeffs.index.name = dim
+    return coeffs
+
+
+def coefficient_sets(coeffs, dim='draw'):
+    """
+    Return the response coefficients as a dict of scalars or DataArrays along 'dim'
+
+    Inputs:
+        - coeffs : Pandas Series (one set) or DataFrame (one set per row, e.g. from
+                   read_regression) with the COEFFS entries
+        - dim : Name of the extra dimension of a DataFrame, defaults to its index name or 'draw'
+    """
+    if isinstance(coeffs, pd.Series):
+        return {name: float(coeffs[name]) for name in COEFFS}
+    dim = coeffs.index.name or dim
+    return {name: xr.DataArray(coeffs[name].to_numpy(dtype=float), dims=[dim],
+                               coords={dim: coeffs.index.to_numpy()}) for name in COEFFS}
+
+
+def response(gdd, egdd, prcp, coeffs, prcp2=None):
+    """
+    Linear yield response, broadcasting over any arrays (xarray, Pandas or numpy)
+
+    Inputs:
+        - gdd/egdd/prcp : Growing degree days, extreme growing degree days and precipitation
+        - coeffs : Dict of coefficients from coefficient_sets
+        - prcp2 : Squared precipitation, prcp**2 if None (pass it for aggregated data,
+                  where the mean of the square is not the square of the mean)
+    """
+    if prcp2 is None:
+        prcp2 = prcp ** 2
+    return coeffs['alpha'] * gdd + coeffs['beta'] * egdd + coeffs['delta1'] * prcp - coeffs['delta2'] * prcp2
+
+
+def east_mask(lon, meridian=EAST_WEST_LON):
+    """
+    Boolean DataArray over a longitude coordinate, True east of 'meridian' (degrees E)
+
+    Matches the first longitude index strictly above 'meridian' used in the notebooks.
+    """
+    lon = xr.DataArray(lon) if not isinstance(lon, xr.DataArray) else lon
+    return lon > meridian
+
+
+def GridImpact(gdd, egdd, prcp, east=EAST, west=None, meridian=EAST_WEST_LON, diff=True, time='time', lon='lon'):
+    """
+    Yield impact over whole (time x lat x lon) cubes
+
+    Inputs:
+        - gdd/egdd/prcp : xarray DataArrays with time, latitude and longitude dimensions
+        - east/west : Coefficient sets (see coefficient_sets) of either side of 'meridian'.
+                      The impact is 0 west of the split if 'west' is None, as in the GMFD
+                      yield calculation. A DataFrame of sets adds its index as a leading dimension.
+        - meridian : Longitude (degrees E) of the east/west split
+        - diff : Apply the response to year-on-year differences, as in the GMFD yield calculation
+        - time/lon : Names of the time and longitude dimensions
+    """
+    mask = east_mask(gdd[lon], meridian)
+    prcp2 = prcp ** 2
+    if diff:
+        gdd, egdd, prcp, prcp2 = [arr.diff(time) for arr in [gdd, egdd, prcp, prcp2]]
+    impact = response(gdd, egdd, prcp, coefficient_sets(east), prcp2)
+    other = 0. if west is None else response(gdd, egdd, prcp, coefficient_sets(west), prcp2)
+    # Any coefficient dimension first, then the dimensions of the cube
+    return xr.where(mask, impact, other).transpose(..., *gdd.dims)
+
+
+def CountyImpact(agvars, coeffs):
+    """
+    Yield impact of county-level variables with county-specific coefficients
+
+    Inputs:
+        - agvars : Pandas DataFrame indexed by (GEOID, Year) with gdd, egdd and prcp columns,
+                   and prcp2 (the aggregated squared precipitation) if available
+        - coeffs : DataFrame of coefficients indexed by GEOID (see read_regression)
+    Returns a Pandas Series indexed by (GEOID, Year), NaN for counties without coefficients
+    """
+    sets = coeffs.reindex(agvars.index.get_level_values('GEOID'))
+    sets.index = agvars.index
+    prcp2 = agvars['prcp2'] if 'prcp2' in agvars.columns else None
+    return response(agvars['gdd'], agvars['egdd'], agvars['prcp'], sets, prcp2)
+
+
+def precip_response(prcp, x, y):
+    """
+    Tabulated precipitation response of the old response functions (data/OLDresponse)
+
+    Piecewise linear through (0, 0) and the table, extrapolated linearly beyond it as the
+    interp1d(..., fill_value="extrapolate") of the old notebooks. Works on any array.
+
+    Inputs:
+        - prcp : Precipitation
+        - x/y : Tables, e.g. np.load('maize_east_precip_x.npy'), np.load('maize_east_precip_y.npy')[:,0]
+    """
+    x = np.insert(np.asarray(x, dtype=float), 0, 0.)
+    y = np.insert(np.asarray(y, dtype=float), 0, 0.)
+    values = np.asarray(prcp, dtype=float)
+    out = np.interp(values, x, y)
+    low, high = values < x[0], values > x[-1]
+    out[low] = y[0] + (values[low] - x[0]) * (y[1] - y[0]) / (x[1] - x[0])
+    out[high] = y[-1] + (values[high] - x[-1]) * (y[-1] - y[-2]) / (x[-1] - x[-2])
+    if isinstance(prcp, xr.DataArray):
+        return prcp.copy(data=out)
+    return out
@@ -0,0 +1,325 @@
+import hashlib
+import os
+import socket
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import geopandas as gp
+import shapely
+
+# Bounds of the CONUS grid cells used by the grid calculations (degrees N, degrees E)
+US_LAT = (24., 50.)
+US_LON = (360. - 125., 360. - 66.)
+
+# Spurious intersections with smaller areas (deg^2) are dropped, as in the grid notebooks
+MIN_AREA = 10e-11
+
+# Parts of a shapefile that define its contents
+SHP_PARTS = ['.shp', '.shx', '.dbf', '.prj']
+
+
+def grid_cells(lat, lon, lat_range=US_LAT, lon_range=US_LON):
+    """
+    Build the CONUS cells of a regular lat/lon grid as boxes, without looping over cells
+
+    Inputs:
+        - lat : Array of grid latitudes (cell centres)
+        - lon : Array of grid longitudes (cell centres, 0-360)
+        - lat_range/lon_range : Open intervals of the cell centres to keep
+    Returns a GeoDataFrame with the cell 'geometry' and the 'latitude'/'longitude' indices
+    of each cell in the original grid, ordered longitude first as in the notebooks
+    """
+    lat, lon = np.asarray(lat), np.asarray(lon)
+    lat_step = abs(lat[1] - lat[0])
+    lon_step = abs(lon[1] - lon[0])
+    US_lat = np.flatnonzero((lat > lat_range[0]) & (lat < lat_range[1]))
+    US_lon = np.flatnonzero((lon > lon_range[0]) & (lon < lon_range[1]))
+    ix, iy = [a.ravel() for a in np.meshgrid(US_lon, US_lat, indexing='ij')]
+    x, y = lon[ix] - 360., lat[iy]
+    cells = shapely.box(x - lon_step / 2, y - lat_step / 2, x + lon_step / 2, y + lat_step / 2)
+    return gp.GeoDataFrame({'geometry': cells, 'latitude': iy, 'longitude': ix}, crs='EPSG:4269')
+
+
+def _clip(left, right):
+    # Intersect every geometry of 'left' with the 'right' geometries it touches
+    # Returns (left rows, right rows, pieces, inside), empty pieces removed, with 'inside'
+    # flagging the pieces that are the unclipped right geometry
+    right = np.asarray(right)
+    shapely.prepare(left)
+    # Only index the right geometries within the bounds of all left ones
+    sel = _within_bounds(right, shapely.total_bounds(left))
+    i, j = shapely.STRtree(right[sel]).query(left, predicate='intersects')
+    j = sel[j]
+    # Cells entirely inside need no clipping
+    inside = shapely.contains_properly(left[i], right[j])
+    pieces = right[j].copy()
+    pieces[~inside] = _intersection(left[i[~inside]], right[j[~inside]])
+    keep = ~shapely.is_empty(pieces)
+    return i[keep], j[keep], pieces[keep], inside[keep]
+
+
+def _within_bounds(geoms, bounds):
+    # Positions of the geometries whose bounding boxes overlap 'bounds'
+    b = shapely.bounds(geoms)
+    return np.flatnonzero((b[:, 2] >= bounds[0]) & (b[:, 0] <= bounds[2]) & (b[:, 3] >= bounds[1]) & (b[:, 1] <= bounds[3]))
+
+
+def _intersection(geoms, others):
+    # Pairwise intersection, using the much faster rectangle clipping where 'others' are boxes
+    out = np.empty(len(geoms), dtype=object)
+    boxes = _is_box(others)
+    out[boxes] = _clip_by_rect(geoms[boxes], shapely.bounds(others[boxes]))
+    out[~boxes] = shapely.intersection(geoms[~boxes], others[~boxes])
+    return out
+
+
+def _clip_by_rect(geoms, bounds):
+    # Clip each geometry to its own rectangle (xmin, ymin, xmax, ymax). The clip_by_rect ufunc
+    # broadcasts over rectangles, unlike its scalar-only public wrapper, but is not public API
+    if hasattr(shapely.lib, 'clip_by_rect'):
+        return shapely.lib.clip_by_rect(geoms, *bounds.T)
+    return shapely.intersection(geoms, shapely.box(*bounds.T))
+
+
+def _is_box(geoms):
+    # Flag axis-aligned rectangles
+    bounds = shapely.bounds(geoms)
+    box_area = (bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1])
+    return np.isclose(shapely.area(geoms), box_area, rtol=1e-12, atol=0.) & (shapely.get_num_coordinates(geoms) == 5)
+
+
+def _overlap_area(a, b):
+    # Area of the intersection of two arrays of box bounds
+    width = np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])
+    height = np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])
+    return np.clip(width, 0., None) * np.clip(height, 0., None)
+
+
+def county_weights(counties, cells, fracs=None, min_area=MIN_AREA):
+    """
+    Within-county weights of grid cells, weighted by the area fraction of the crop
+
+    Candidate county/cell (and cell/fraction) pairs come from an STRtree, and only the
+    pairs on a county boundary are clipped - cells inside a county are intersected with
+    the (box) raster pixels from their bounds. Equivalent to the two gp.overlay steps of the
+    grid notebooks: the weight of each piece is frac * area, normalised per county, with
+    pieces below 'min_area' dropped. Pieces of the same county and cell are summed.
+
+    Inputs:
+        - counties : GeoDataFrame of counties with 'STATEFP', 'COUNTYFP' and 'GEOID'
+        - cells : GeoDataFrame of grid cells from grid_cells
+        - fracs : (frac, transform) raster of area fractions (see data/raster/fracs.py), or
+                  GeoDataFrame of area fraction polygons with a 'frac' column (area_fracs.shp),
+                  plain area weights if None
+        - min_area : Smallest intersection area kept (deg^2)
+    Returns a DataFrame with columns STATEFP, COUNTYFP, GEOID, latitude, longitude, within_county_weight
+    """
+    county_geom = counties.geometry.to_numpy()
+    ci, gi, pieces, inside = _clip(county_geom, cells.geometry.to_numpy())
+    if fracs is None:
+        frac = np.ones(len(pieces))
+        area = shapely.area(pieces)
+    elif isinstance(fracs, tuple):
+        pi, frac, area = _raster_coverage(pieces, inside, *fracs)
+        ci, gi = ci[pi], gi[pi]
+    else:
+        # Pair the pieces with the fraction polygons whose bounding boxes they overlap. No
+        # intersects predicate is needed: pairs that do not intersect get a zero area below
+        frac_geom = fracs.geometry.to_numpy()
+        sel = _within_bounds(frac_geom, shapely.total_bounds(pieces))
+        pi, fi = shapely.STRtree(frac_geom[sel]).query(pieces)
+        fi = sel[fi]
+        area = np.empty(len(pi))
+        # Whole cells and raster pixels are both boxes, and so is the part of a county
+        # boundary cell within a pixel that lies inside the county, so only pixels on
+        # county boundaries need clipping
+        is_box = _is_box(frac_geom)[fi]
+        boxes = inside[pi] & is_box
+        edge = np.flatnonzero(~boxes & is_box)
+        within = edge[shapely.contains_properly(county_geom[ci[pi[edge]]], frac_geom[fi[edge]])]
+        boxes[within] = True
+        cell_bounds = shapely.bounds(cells.geometry.to_numpy()[gi[pi[boxes]]])
+        area[boxes] = _overlap_area(cell_bounds, shapely.bounds(frac_geom[fi[boxes]]))
+        area[~boxes] = shapely.area(_intersection(pieces[pi[~boxes]], frac_geom[fi[~boxes]]))
+        ci, gi = ci[pi], gi[pi]
+        frac = fracs['frac'].to_numpy(dtype=float)[fi]
+    return _finish(counties, cells, ci, gi, frac, area, min_area)
+
+
+def _pixel_pairs(bounds, transform, shape):
+    # All (geometry, row, col) of raster pixels overlapping the bounds of each geometry
+    a, _, c, _, e, f = transform
+    col0 = np.clip(np.floor((bounds[:, 0] - c) / a), 0, shape[1]).astype(int)
+    col1 = np.clip(np.ceil((bounds[:, 2] - c) / a), 0, shape[1]).astype(int)
+    row0 = np.clip(np.floor((bounds[:, 3] - f) / e), 0, shape[0]).astype(int)
+    row1 = np.clip(np.ceil((bounds[:, 1] - f) / e), 0, shape[0]).astype(int)
+    ncol = np.maximum(col1 - col0, 0)
+    counts = ncol * np.maximum(row1 - row0, 0)
+    geom = np.repeat(np.arange(len(bounds)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return geom, row0[geom] + k // ncol[geom], col0[geom] + k % ncol[geom]
+
+
+def _raster_coverage(pieces, inside, frac, transform):
+    # Exact area of every piece within each raster pixel, from the pixel bounds
+    # Returns (piece rows, pixel fractions, areas)
+    a, _, c, _, e, f = transform
+    pi, row, col = _pixel_pairs(shapely.bounds(pieces), transform, frac.shape)
+    xmin = c + col * a
+    ymax = f + row * e
+    rects = np.stack([xmin, ymax + e, xmin + a, ymax], axis=1)
+    area = np.empty(len(pi))
+    # Whole cells only need the overlap of two boxes
+    box = inside[pi]
+    area[box] = _overlap_area(shapely.bounds(pieces[pi[box]]), rects[box])
+    area[~box] = shapely.area(_clip_by_rect(pieces[pi[~box]], rects[~box]))
+    return pi, frac[row, col].astype(float), area
+
+
+def _finish(counties, cells, ci, gi, frac, area, min_area):
+    # Drop spurious pieces, sum pieces per county and cell, and normalise per county
+    keep = area > min_area
+    final = pd.DataFrame({'county': ci[keep], 'latitude': cells['latitude'].to_numpy()[gi[keep]],
+                          'longitude': cells['longitude'].to_numpy()[gi[keep]],
+                          'county_weight': frac[keep] * area[keep]})
+    final = final.groupby(['county', 'latitude', 'longitude'], as_index=False, sort=False).sum()
+    # Normalise
+    total = final.groupby('county')['county_weight'].transform('sum')
+    final['within_county_weight'] = (final['county_weight'] / total).fillna(0)
+    for col in ['STATEFP', 'COUNTYFP', 'GEOID']:
+        if col in counties.columns:
+            final.insert(final.columns.get_loc('latitude'), col, counties[col].to_numpy()[final['county']])
+    return final.drop(columns=['county', 'county_weight'])
+
+
+def compare(weights, path):
+    """
+    Largest absolute difference between weights and an existing counties_*_weighted.csv
+
+    The existing tables hold one row per county/cell/fraction piece, which are summed first.
+    """
+    old = pd.read_csv(path, dtype={'GEOID': str})
+    old['GEOID'] = old['GEOID'].str.zfill(5)
+    old = old.groupby(['GEOID', 'latitude', 'longitude'])['within_county_weight'].sum()
+    new = weights.set_index(['GEOID', 'latitude', 'longitude'])['within_county_weight']
+    both = pd.concat([new, old], axis=1, keys=['new', 'old']).fillna(0)
+    return (both['new'] - both['old']).abs().max()
+
+
+def fingerprint(path):
+    """
+    SHA-256 of the contents of a file, or of all parts of a shapefile
+    """
+    digest = hashlib.sha256()
+    root, ext = os.path.splitext(path)
+    parts = [root + part for part in SHP_PARTS if os.path.exists(root + part)] if ext == '.shp' else [path]
+    for part in parts:
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def grid_key(lat, lon, county_path, fracs_path=None, lat_range=US_LAT, lon_range=US_LON, min_area=MIN_AREA):
+    """
+    Hash of everything the weights depend on: the grid, the CONUS bounds and the input files
+    """
+    digest = hashlib.sha256()
+    for arr in [lat, lon, lat_range, lon_range, [min_area]]:
+        digest.update(np.ascontiguousarray(arr, dtype='<f8').tobytes())
+        digest.update(b'|')
+    digest.update(fingerprint(county_path).encode())
+    digest.update((fingerprint(fracs_path) if fracs_path else 'none').encode())
+    return digest.hexdigest()
+
+
+def _write_atomic(data, path):
+    # Write to a temporary file next to 'path' and move it into place, so readers never
+    # see a partial file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            data.to_csv(f, index=False)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def _read_fracs(path):
+    # Raster product of data/raster/fracs.py (.npz) or area fraction polygons
+    if path.endswith('.npz'):
+        with np.load(path) as f:
+            return f['frac'], tuple(f['transform'])
+    return gp.read_file(path)
+
+
+def _read_weights(path):
+    return pd.read_csv(path, dtype={'STATEFP': str, 'COUNTYFP': str, 'GEOID': str})
+
+
+def cached_weights(lat, lon, county_path, fracs_path=None, cache_dir='./cache', stale=3600.):
+    """
+    county_weights for a grid, reusing the result of any earlier run on the same grid and inputs
+
+    Results are stored in 'cache_dir' under grid_key, so models sharing a grid share one
+    calculation. Safe for concurrent array tasks: the first task to claim a key writes its
+    host and PID into a lock file and computes it while the others wait for its file, and
+    files are written atomically. A lock older than 'stale' seconds is left by a task that
+    died and is taken over (two waiters taking it over at once at worst compute it twice).
+
+    Inputs:
+        - lat/lon : Arrays of grid latitudes and longitudes (0-360)
+        - county_path : County shapefile
+        - fracs_path : Area fraction raster (area_fracs.npz) or shapefile, plain area weights if None
+        - cache_dir : Directory of cached weights, shared between tasks
+        - stale : Age (s) of another task's lock after which it is taken over
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = grid_key(lat, lon, county_path, fracs_path)
+    path = os.path.join(cache_dir, 'weights_' + key + '.csv')
+    lock = path + '.lock'
+    owner = socket.gethostname() + ':' + str(os.getpid())
+    while not os.path.exists(path):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another task is computing this grid, wait unless its lock is stale
+            try:
+                age = time.time() - os.path.getmtime(lock)
+            except FileNotFoundError:
+                continue
+            if age < stale:
+                time.sleep(5.)
+            else:
+                _remove(lock)
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write(owner)
+        try:
+            if os.path.exists(path):
+                break
+            counties = gp.read_file(county_path)
+            fracs = _read_fracs(fracs_path) if fracs_path else None
+            weights = county_weights(counties, grid_cells(lat, lon), fracs)
+            _write_atomic(weights, path)
+            return weights
+        finally:
+            # Only remove our own lock, not one that replaced it after a takeover
+            try:
+                with open(lock) as f:
+                    mine = f.read() == owner
+            except FileNotFoundError:
+                mine = False
+            if mine:
+                _remove(lock)
+    return _read_weights(path)
+
+
+def _remove(path):
+    # Remove a file another task may have removed already
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
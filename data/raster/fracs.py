@@ -0,0 +1,56 @@
+import os
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# EarthStat harvested maize area fractions (http://www.earthstat.org/harvested-area-yield-4-crops-1995-2005/)
+MAIZE = [os.path.join(HERE, 'earthstat/HarvAreaYield_4Crops_95-00-05_Geotiff/Maize/Maize_{}_Area.tif'.format(year))
+         for year in [1995, 2000, 2005]]
+
+# Conterminous USA
+BOUNDARY = os.path.join(HERE, 'usa_bounds/usa-boundary-dissolved.shp')
+
+# Compact area fraction product, replacing output/area_fracs.shp
+FRACS = os.path.join(HERE, 'output/area_fracs.npz')
+
+
+def BuildFracs(tifs=MAIZE, boundary=BOUNDARY, path=FRACS):
+    """
+    Average harvested area fraction rasters over the USA, without building pixel polygons
+
+    Each GeoTIFF is read only over the window of the boundary. Pixels outside the boundary,
+    or without data (negative), are 0 as in area_frac.ipynb. The mean fraction is saved as an
+    array with its affine transform in a compressed .npz (see load_fracs).
+
+    Inputs:
+        - tifs : Paths of the area fraction GeoTIFFs to average (same grid)
+        - boundary : Shapefile of the region to keep
+        - path : File to save the product to
+    """
+    import geopandas as gp
+    import rasterio as rio
+    from rasterio.features import geometry_mask
+    from rasterio.windows import from_bounds
+    fracs = []
+    for tif in tifs:
+        with rio.open(tif) as src:
+            region = gp.read_file(boundary).to_crs(src.crs)
+            window = from_bounds(*region.total_bounds, transform=src.transform)
+            window = window.round_offsets(op='floor').round_lengths(op='ceil')
+            data = src.read(1, window=window, boundless=True, fill_value=-1).astype(np.float64)
+            transform = src.window_transform(window)
+        inside = ~geometry_mask(region.geometry, out_shape=data.shape, transform=transform)
+        fracs.append(np.where(inside & (data >= 0.), data, 0.))
+    frac = np.mean(fracs, axis=0)
+    tmp = path + '.tmp.npz'
+    np.savez_compressed(tmp, frac=frac, transform=np.array(transform)[:6], crs=str(region.crs))
+    os.replace(tmp, path)
+    return frac, transform
+
+
+def load_fracs(path=FRACS):
+    """
+    Return (frac, transform) of a product saved by BuildFracs, transform as its 6 affine coefficients
+    """
+    with np.load(path) as f:
+        return f['frac'], tuple(f['transform'])